@@ -1,10 +1,16 @@
 import binascii
 import os
+import time
 
 import django
+from django.core.cache import cache
 from django.db import models
 from django.db.models.manager import EmptyManager
+from django.db.models.signals import post_delete, post_save
 from django.contrib.auth.models import Group
+from django.dispatch import receiver
+
+from betty.conf.app import settings
 
 
 class BettyCropperUser(object):
@@ -83,8 +89,42 @@ def random_token():
     return binascii.hexlify(os.urandom(20))
 
 
+# Maps public tokens to (expiration time, permissions), in front of the Django cache
+_permissions_cache = {}
+
+
+def permissions_cache_key(public_token):
+    return "api-token-{}".format(public_token)
+
+
 class ApiTokenManager(models.Manager):
 
+    def get_user(self, public_token):
+        """Returns a BettyCropperUser for a public token, or None if there's no such token
+
+        The token's permissions are cached, in local memory and in the Django cache,
+        for BETTY_API_TOKEN_CACHE_TTL seconds."""
+        ttl = settings.BETTY_API_TOKEN_CACHE_TTL
+        now = time.time()
+
+        cached = _permissions_cache.get(public_token)
+        if cached is not None and cached[0] > now:
+            return BettyCropperUser(cached[1])
+
+        permissions = cache.get(permissions_cache_key(public_token)) if ttl else None
+        if permissions is None:
+            try:
+                token = self.get(public_token=public_token)
+            except self.model.DoesNotExist:
+                return None
+            permissions = token.get_permissions()
+            if ttl:
+                cache.set(permissions_cache_key(public_token), permissions, ttl)
+
+        if ttl:
+            _permissions_cache[public_token] = (now + ttl, permissions)
+        return BettyCropperUser(permissions)
+
     def create_superuser(self):
         return self.create(
             image_read_permission=True,
@@ -122,7 +162,7 @@ class ApiToken(models.Model):
     image_add_permsission = models.BooleanField(default=False)
     image_delete_permission = models.BooleanField(default=False)
 
-    def get_user(self):
+    def get_permissions(self):
         permissions = []
         if self.image_read_permission:
             permissions.append("server.image_read")
@@ -134,4 +174,14 @@ class ApiToken(models.Model):
             permissions.append("server.image_add")
         if self.image_delete_permission:
             permissions.append("server.image_delete")
-        return BettyCropperUser(permissions)
+        return permissions
+
+    def get_user(self):
+        return BettyCropperUser(self.get_permissions())
+
+
+@receiver(post_save, sender=ApiToken)
+@receiver(post_delete, sender=ApiToken)
+def clear_permissions_cache(sender, instance, **kwargs):
+    _permissions_cache.pop(instance.public_token, None)
+    cache.delete(permissions_cache_key(instance.public_token))
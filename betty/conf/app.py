@@ -30,14 +30,38 @@ DEFAULTS = {
         (153, 51, 153)
     ),
     "BETTY_PLACEHOLDER_FONT": os.path.join(PACKAGE_DIR, "cropper/font/OpenSans-Semibold.ttf"),
+    "BETTY_PLACEHOLDER_CACHE_SIZE": 128,
     "BETTY_PUBLIC_TOKEN": None,
     "BETTY_PRIVATE_TOKEN": None,
     "BETTY_CACHE_FLUSHER": None,
+    "BETTY_CACHE_FLUSHER_BATCH_SIZE": None,
+    "BETTY_CACHE_FLUSHER_RETRIES": 5,
+    "BETTY_VERSIONED_URLS": False,
+    "BETTY_VERSIONED_CACHE_MAX_AGE": 60 * 60 * 24 * 365,
+    "BETTY_API_TOKEN_CACHE_TTL": 60,
     "BETTY_DEFAULT_IMAGE": None,
     "BETTY_MAX_WIDTH": 3200,
     "BETTY_DEFAULT_JPEG_QUALITY": 80,
     "BETTY_JPEG_MAX_ERROR": 3.5,
     "BETTY_JPEG_QUALITY_RANGE": None,
+    "BETTY_JPEG_QUALITY_SEARCH_THREADS": 1,
+    "BETTY_JPEG_DRAFT_MODE": True,
+    "BETTY_JPEG_ENCODER_PROFILES": [
+        (0, {"optimize": True}),
+        (601, {"optimize": True, "progressive": True}),
+    ],
+    "BETTY_WEBP_QUALITY": 80,
+    "BETTY_AVIF_QUALITY": 60,
+    "BETTY_AUTO_FORMATS": [],
+    "BETTY_ASYNC_INGEST": False,
+    "BETTY_DEDUPE": None,
+    "BETTY_WARM_CROPS": False,
+    "BETTY_WARM_EXTENSIONS": ("jpg",),
+    "BETTY_POPULAR_WIDTHS": [],
+    "BETTY_SEARCH_BACKEND": "betty.cropper.search.DatabaseSearchBackend",
+    "BETTY_METRICS_ENABLED": False,
+    "BETTY_SENDFILE_HEADER": None,
+    "BETTY_SENDFILE_ROOT": None,
 }
 
 
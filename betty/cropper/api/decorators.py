@@ -33,12 +33,11 @@ def betty_token_auth(permissions):
                         return forbidden()
 
                     api_key = request.META["HTTP_X_BETTY_API_KEY"]
-                    try:
-                        token = ApiToken.objects.get(public_token=api_key)
-                    except ApiToken.DoesNotExist:
+                    user = ApiToken.objects.get_user(api_key)
+                    if user is None:
                         return forbidden()
 
-                    request.user = token.get_user()
+                    request.user = user
                 if not request.user.has_perms(permissions):
                     return forbidden()
 
@@ -1,6 +1,4 @@
 import json
-import os
-import shutil
 
 from django.core.cache import cache
 from django.http import (
@@ -14,9 +12,18 @@ from django.views.decorators.cache import never_cache
 
 from betty.conf.app import settings
 from .decorators import betty_token_auth
-from betty.cropper.models import Image
+from betty.cropper.models import Image, Ratio, is_saved_width
+from betty.cropper.search import get_search_backend
+from betty.cropper.tasks import flush_cache, warm_crops
+from betty.cropper.views import EXTENSION_MAP
 
 
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# The most crops a single render request can ask for
+RENDER_MAX_TARGETS = 100
+
 ACC_HEADERS = {
     'Access-Control-Allow-Origin': '*',
     'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
@@ -57,14 +64,29 @@ def new(request):
     if image_file is None:
         return HttpResponseBadRequest(json.dumps({'message': 'No image'}))
 
-    image = Image.objects.create_from_path(
-        image_file.temporary_file_path(),
+    image = Image.objects.create_from_file(
+        image_file,
         filename=image_file.name,
         name=request.POST.get("name"),
         credit=request.POST.get("credit")
     )
 
-    return HttpResponse(json.dumps(image.to_native()), content_type="application/json")
+    if settings.BETTY_ASYNC_INGEST:
+        # The optimized image may not exist yet, but selections are made against it, so
+        # report its size (without caching it, since crops still come from the source).
+        image.scale_to_max_width()
+        data = image.serialize()
+    else:
+        data = image.to_native()
+
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def flush_crop_urls(urls):
+    """Queues a purge of the given crop URLs from any upstream caches"""
+    # Versioned URLs change along with the selection, so there's nothing to purge
+    if urls and settings.BETTY_CACHE_FLUSHER and not settings.BETTY_VERSIONED_URLS:
+        flush_cache.apply_async(args=(urls,))
 
 
 @never_cache
@@ -95,7 +117,7 @@ def update_selection(request, image_id, ratio_slug):
         message = json.dumps({"message": "Bad selection"})
         return HttpResponseBadRequest(message, content_type="application/json")
 
-    if ratio_slug not in settings.BETTY_RATIOS:
+    if ratio_slug == "original" or Ratio.get(ratio_slug) is None:
         message = json.dumps({"message": "No such ratio"})
         return HttpResponseBadRequest(message, content_type="application/json")
 
@@ -103,39 +125,129 @@ def update_selection(request, image_id, ratio_slug):
         image.selections = {}
 
     image.selections[ratio_slug] = selection
-    cache.delete(image.cache_key())
     image.save()
 
-    ratio_path = os.path.join(image.path(), ratio_slug)
-    if os.path.exists(ratio_path):
-        if settings.BETTY_CACHE_FLUSHER:
-            for crop in os.listdir(ratio_path):
-                width, format = crop.split(".")
-                ratio = os.path.basename(ratio_path)
-                full_url = image.get_absolute_url(ratio=ratio, width=width, format=format)
-                settings.BETTY_CACHE_FLUSHER(full_url)
-            
-        shutil.rmtree(ratio_path)
+    crop_urls = image.clear_crops(ratios=[ratio_slug])
+    flush_crop_urls(crop_urls)
+
+    if settings.BETTY_WARM_CROPS:
+        warm_crops.apply_async(args=(image.id,), kwargs={"ratios": [ratio_slug]})
 
     return HttpResponse(json.dumps(image.to_native()), content_type="application/json")
 
 
+@never_cache
+@csrf_exempt
+@crossdomain(methods=['POST', 'OPTIONS'])
+@betty_token_auth(["server.image_crop"])
+def render(request, image_id):
+
+    try:
+        image = Image.objects.get(id=image_id)
+    except Image.DoesNotExist:
+        message = json.dumps({"message": "No such image!"})
+        return HttpResponseNotFound(message, content_type="application/json")
+
+    try:
+        request_json = json.loads(request.body.decode("utf-8"))
+    except Exception:
+        message = json.dumps({"message": "Bad JSON"})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    targets = []
+    try:
+        for target in request_json["targets"]:
+            ratio_slug = target["ratio"]
+            width = int(target["width"])
+            extension = target.get("format", "jpg")
+            if Ratio.get(ratio_slug) is None:
+                raise ValueError("No such ratio")
+            if width <= 0 or width > settings.BETTY_MAX_WIDTH or not is_saved_width(width):
+                # Other widths never get saved, so rendering them ahead of time is pointless
+                raise ValueError("Invalid width")
+            if extension not in EXTENSION_MAP:
+                raise ValueError("Invalid format")
+            if (ratio_slug, width, extension) not in targets:
+                targets.append((ratio_slug, width, extension))
+    except (KeyError, TypeError, ValueError):
+        message = json.dumps({"message": "Bad targets"})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    if len(targets) > RENDER_MAX_TARGETS:
+        message = json.dumps({"message": "Too many targets (the most is {0})".format(
+            RENDER_MAX_TARGETS)})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    image.render(targets)
+
+    rendered = [
+        image.get_absolute_url(ratio=ratio_slug, width=width, format=extension)
+        for ratio_slug, width, extension in targets
+    ]
+    return HttpResponse(json.dumps({"rendered": rendered}), content_type="application/json")
+
+
 @never_cache
 @csrf_exempt
 @crossdomain(methods=['GET', 'OPTIONS'])
 @betty_token_auth(["server.image_read"])
 def search(request):
+    """Returns a page of images, newest first (or most relevant first, with a query)
+
+    Pages are fetched with the "cursor" parameter, taken from the "next" Link
+    header. A comma-separated "fields" parameter limits the data returned for
+    each image; leaving out "selections" makes this much cheaper."""
+
+    try:
+        limit = min(int(request.GET.get("limit", SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+        cursor = request.GET.get("cursor")
+        if cursor is not None:
+            cursor = int(cursor)
+        if limit < 1 or (cursor is not None and cursor < 0):
+            raise ValueError("Out of range")
+    except ValueError:
+        message = json.dumps({"message": "Bad limit or cursor"})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    fields = None
+    if request.GET.get("fields"):
+        fields = [field.strip() for field in request.GET["fields"].split(",")]
 
-    results = []
     query = request.GET.get("q")
     if query:
-        for image in Image.objects.filter(name__icontains=query)[:20]:
-            results.append(image.to_native())
+        # Search results are ranked, so the cursor is just an offset into them.
+        offset = cursor or 0
+        queryset = get_search_backend().search(Image.objects.all(), query)
+        images = list(queryset[offset:offset + limit + 1])
     else:
-        for image in Image.objects.all()[:20]:
-            results.append(image.to_native())
+        queryset = Image.objects.order_by("-id")
+        if cursor is not None:
+            queryset = queryset.filter(id__lt=cursor)
+        images = list(queryset[:limit + 1])
+
+    next_cursor = None
+    if len(images) > limit:
+        images = images[:limit]
+        next_cursor = offset + limit if query else images[-1].id
+
+    # Fetch all the cached data for this page at once, rather than one image at a time.
+    cached = cache.get_many([image.cache_key() for image in images])
+    results = []
+    for image in images:
+        data = cached.get(image.cache_key())
+        if data is None:
+            data = image.to_native(fields=fields)
+        elif fields is not None:
+            data = dict((field, data[field]) for field in fields if field in data)
+        results.append(data)
 
-    return HttpResponse(json.dumps({"results": results}), content_type="application/json")
+    response = HttpResponse(json.dumps({"results": results}), content_type="application/json")
+    if next_cursor is not None:
+        params = request.GET.copy()
+        params["cursor"] = str(next_cursor)
+        response["Link"] = '<{0}?{1}>; rel="next"'.format(request.path, params.urlencode())
+        response["Access-Control-Expose-Headers"] = "Link"
+    return response
 
 
 @never_cache
@@ -158,26 +270,31 @@ def detail(request, image_id):
             message = json.dumps({"message": "Bad Request"})
             return HttpResponseBadRequest(message, content_type="application/json")
 
+        old_selections = image.selections or {}
         for field in ("name", "credit", "selections"):
             if field in request_json:
                 setattr(image, field, request_json[field])
-        cache.delete(image.cache_key())
         image.save()
 
+        # Rendered crops are served straight off the disk, so any that were made
+        # with an old selection need to go.
+        new_selections = image.selections or {}
+        changed = [ratio for ratio in settings.BETTY_RATIOS
+                   if old_selections.get(ratio) != new_selections.get(ratio)]
+        if changed:
+            flush_crop_urls(image.clear_crops(ratios=changed))
+            if settings.BETTY_WARM_CROPS:
+                warm_crops.apply_async(args=(image.id,), kwargs={"ratios": changed})
+
         return HttpResponse(json.dumps(image.to_native()), content_type="application/json")
 
     @betty_token_auth(["server.image_read"])
     def get(request, image_id):
-        cache_key = "image-{}".format(image_id)
-        data = cache.get(cache_key)
-        if data is None:
-            try:
-                image = Image.objects.get(id=image_id)
-            except Image.DoesNotExist:
-                message = json.dumps({"message": "No such image!"})
-                return HttpResponseNotFound(message, content_type="application/json")
-            data = image.to_native()
-            cache.set(cache_key, data, 60 * 60)
+        try:
+            data = Image.objects.get_native(image_id)
+        except Image.DoesNotExist:
+            message = json.dumps({"message": "No such image!"})
+            return HttpResponseNotFound(message, content_type="application/json")
 
         return HttpResponse(json.dumps(data), content_type="application/json")
 
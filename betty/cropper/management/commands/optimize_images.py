@@ -1,20 +1,108 @@
+import time
+from multiprocessing import Pool
+from optparse import make_option
 
+from django import db
 from django.core.management.base import BaseCommand
+from django.db.models import Q
 
-from betty.cropper.models import Image
-from betty.cropper.tasks import search_image_quality, optimize_image
+from betty.conf.app import settings
+from betty.cropper.models import Image, optimize_image
+from betty.cropper.tasks import search_image_quality
+
+
+def close_connections():
+    """Database connections can't be shared across a fork, so each process needs its own"""
+    for connection in db.connections.all():
+        connection.close()
+
+
+def process_image(image_id):
+    """Optimizes a single image, returning an error message if that failed"""
+    try:
+        image = Image.objects.get(id=image_id)
+
+        if not image.optimized.name:
+            optimize_image(image)
+
+        if not image.jpeg_quality_searched and settings.BETTY_JPEG_QUALITY_RANGE:
+            search_image_quality.apply(args=(image.id,))
+    except Exception as e:
+        return "{0}: {1}".format(type(e).__name__, e)
 
 
 class Command(BaseCommand):
     help = 'Creates optimal image files, and figures out the best JPEG quality level for each image'
 
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--workers",
+            type="int",
+            dest="workers",
+            default=1,
+            help="Number of processes to optimize images with"),
+        make_option(
+            "--batch-size",
+            type="int",
+            dest="batch_size",
+            default=100,
+            help="Number of images to hand out to the workers at a time"),
+        make_option(
+            "--resume-from-id",
+            type="int",
+            dest="resume_from_id",
+            default=None,
+            help="Skip any images with an id lower than this"),
+    )
+
     def handle(self, *args, **options):
-        for image in Image.objects.iterator():
-            if not image.source.name:
-                continue
+        workers = options.get("workers") or 1
+        batch_size = options.get("batch_size") or 100
+
+        pending = Q(optimized__isnull=True) | Q(optimized="")
+        if settings.BETTY_JPEG_QUALITY_RANGE:
+            pending |= Q(jpeg_quality_searched=False)
+        queryset = Image.objects.exclude(
+            Q(source__isnull=True) | Q(source="")
+        ).filter(pending).order_by("id")
+        if options.get("resume_from_id"):
+            queryset = queryset.filter(id__gte=options["resume_from_id"])
+
+        pool = None
+        if workers > 1:
+            close_connections()
+            pool = Pool(workers, initializer=close_connections)
+
+        processed = 0
+        started = time.time()
+        last_id = None
+        try:
+            while True:
+                batch_queryset = queryset
+                if last_id is not None:
+                    batch_queryset = batch_queryset.filter(id__gt=last_id)
+                image_ids = list(batch_queryset.values_list("id", flat=True)[:batch_size])
+                if not image_ids:
+                    break
+
+                if pool is not None:
+                    errors = pool.map(process_image, image_ids)
+                else:
+                    errors = [process_image(image_id) for image_id in image_ids]
 
-            if not image.optimized.name:
-                optimize_image.apply(args=(image.id,))
+                for image_id, error in zip(image_ids, errors):
+                    if error:
+                        self.stderr.write("Image {0} failed: {1}\n".format(image_id, error))
 
-            if image.jpeg_quality is None:
-                search_image_quality.apply(args=(image.id,))
+                # Every image in the batch is done, so this is a safe place to restart from.
+                last_id = image_ids[-1]
+                processed += len(image_ids)
+                rate = processed / max(time.time() - started, 0.001)
+                self.stdout.write(
+                    "Processed {0} images ({1:.2f} images/s), "
+                    "resume with --resume-from-id={2}\n".format(processed, rate, last_id + 1)
+                )
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
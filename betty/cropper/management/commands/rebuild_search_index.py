@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from betty.cropper.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Builds (or re-builds) the index used to search images by name and credit'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.build_index()
+        self.stdout.write("Built search index for {0}\n".format(type(backend).__name__))
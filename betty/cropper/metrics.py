@@ -0,0 +1,159 @@
+"""Counters and timings for the crop path, exposed in the Prometheus text format
+
+Metrics are only collected when BETTY_METRICS_ENABLED is on. They're kept in
+memory, per process, so each worker process needs to be scraped on its own."""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from betty.conf.app import settings
+
+
+# Upper bounds of the width buckets that crops are grouped into
+WIDTH_BUCKETS = (160, 320, 640, 960, 1280, 1600)
+
+
+def width_bucket(width):
+    if width is None:
+        return None
+    for bucket in WIDTH_BUCKETS:
+        if int(width) <= bucket:
+            return str(bucket)
+    return "+Inf"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def label_values(self, labels):
+        values = (labels.get(label) for label in self.labels)
+        return tuple("" if value is None else str(value) for value in values)
+
+    def format_labels(self, label_values):
+        return ",".join(
+            '{0}="{1}"'.format(label, escape(value))
+            for label, value in zip(self.labels, label_values)
+        )
+
+    def samples(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.help),
+            "# TYPE {0} {1}".format(self.name, self.type),
+        ]
+        with self.lock:
+            samples = sorted(self.samples())
+        for name, label_values, value in samples:
+            lines.append("{0}{{{1}}} {2}".format(name, self.format_labels(label_values), value))
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not settings.BETTY_METRICS_ENABLED:
+            return
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Summary(Metric):
+    """Keeps a count and a total of the observed values, for working out averages"""
+
+    type = "summary"
+
+    def observe(self, value, **labels):
+        if not settings.BETTY_METRICS_ENABLED:
+            return
+        key = self.label_values(labels)
+        with self.lock:
+            count, total = self.values.get(key, (0, 0.0))
+            self.values[key] = (count + 1, total + value)
+
+    def samples(self):
+        samples = []
+        for key, (count, total) in self.values.items():
+            samples.append((self.name + "_count", key, count))
+            samples.append((self.name + "_sum", key, total))
+        return samples
+
+
+registry = []
+
+CROP_LABELS = ("ratio", "width", "extension")
+
+crop_stage_seconds = Summary(
+    "betty_crop_stage_seconds",
+    "Time spent in each stage of rendering a crop.",
+    ("stage",) + CROP_LABELS
+)
+crop_requests = Counter(
+    "betty_crop_requests_total",
+    "Crop requests, by how they were answered.",
+    ("result",) + CROP_LABELS
+)
+crop_bytes = Counter(
+    "betty_crop_bytes_total",
+    "Bytes of image data served for crop requests.",
+    CROP_LABELS
+)
+
+
+def crop_labels(ratio, width, extension):
+    return {"ratio": ratio, "width": width_bucket(width), "extension": extension}
+
+
+@contextmanager
+def timed(stage, ratio, width, extension):
+    """Records how long the block takes, as one stage of rendering a crop
+
+    Stages that are shared by several crops (like decoding the source for a batch)
+    leave the labels that don't apply as None."""
+    if not settings.BETTY_METRICS_ENABLED:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        crop_stage_seconds.observe(
+            time.time() - started, stage=stage, **crop_labels(ratio, width, extension))
+
+
+def record_request(result, ratio, width, extension, size=None):
+    """Counts a crop request, along with the bytes sent back, if any"""
+    labels = crop_labels(ratio, width, extension)
+    crop_requests.inc(result=result, **labels)
+    if size:
+        crop_bytes.inc(size, **labels)
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AnonymousUser
-from .auth import ApiToken
+
+from betty.authtoken.models import ApiToken
 
 
 class BettyApiKeyMiddleware(object):
@@ -9,9 +10,8 @@ class BettyApiKeyMiddleware(object):
             return
 
         api_key = request.META["HTTP_X_BETTY_API_KEY"]
-        try:
-            token = ApiToken.objects.get(public_token=api_key)
-        except ApiToken.DoesNotExist:
+        user = ApiToken.objects.get_user(api_key)
+        if user is None:
             request.user = AnonymousUser()
         else:
-            request.user = token.get_user()
+            request.user = user
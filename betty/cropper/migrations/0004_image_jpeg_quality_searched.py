@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def mark_searched(apps, schema_editor):
+    # Any image that already has a quality level has been through the search
+    Image = apps.get_model('cropper', 'Image')
+    Image.objects.filter(jpeg_quality__isnull=False).update(jpeg_quality_searched=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropper', '0003_image_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='jpeg_quality_searched',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(mark_searched, lambda apps, schema_editor: None),
+    ]
@@ -1,8 +1,17 @@
+import errno
+import hashlib
 import io
+import json
 import os
 import shutil
+import tempfile
+from collections import OrderedDict
 
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 from django.core.urlresolvers import reverse
 
@@ -10,11 +19,15 @@ from PIL import Image as PILImage
 from PIL import JpegImagePlugin
 
 from betty.conf.app import settings
-from betty.cropper.tasks import search_image_quality
+from betty.cropper import metrics
+from betty.cropper.tasks import ingest_image, search_image_quality, warm_crops
 
 from jsonfield import JSONField
 
 
+# How long the serialized data for an image is cached
+NATIVE_CACHE_TIMEOUT = 60 * 60
+
 betty_storage = FileSystemStorage(
     location=settings.BETTY_IMAGE_ROOT,
     base_url=settings.BETTY_IMAGE_URL
@@ -30,6 +43,136 @@ def optimized_upload_to(instance, filename):
     return os.path.join(instance.path(), "optimized{}".format(ext))
 
 
+def jpeg_encoder_profile(width):
+    """Returns the extra JPEG encoder options for crops of the given width
+
+    BETTY_JPEG_ENCODER_PROFILES is a list of (minimum width, options) pairs; the
+    last one that applies wins."""
+    options = {}
+    for min_width, profile in settings.BETTY_JPEG_ENCODER_PROFILES:
+        if width >= min_width:
+            options = profile
+    return dict(options)
+
+
+def encoder_signature(extension, width):
+    """Describes the encoder settings used for crops of the given extension and width
+
+    Crop ETags include this, so that changing the settings changes the ETags."""
+    if extension == "jpg":
+        options = [settings.BETTY_DEFAULT_JPEG_QUALITY, sorted(jpeg_encoder_profile(width).items())]
+    elif extension == "webp":
+        options = [settings.BETTY_WEBP_QUALITY]
+    elif extension == "avif":
+        options = [settings.BETTY_AVIF_QUALITY]
+    else:
+        options = []
+    return json.dumps(options)
+
+
+def can_encode(format):
+    """Checks whether this build of Pillow can save images in the given format"""
+    PILImage.init()
+    return format.upper() in PILImage.SAVE
+
+
+def is_saved_width(width):
+    """We only want to save crops to the filesystem if they're one of our usual widths"""
+    return width in settings.BETTY_WIDTHS or len(settings.BETTY_WIDTHS) == 0
+
+
+def atomic_write(path, data):
+    """Writes data to path, so that readers never see a partially-written file
+
+    The data is written to a temporary file in the same directory, which is then
+    renamed into place."""
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != 17:
+            raise e
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def hash_file(fileobj):
+    """Returns the SHA-1 hex digest of a Django File's contents"""
+    sha1 = hashlib.sha1()
+    for chunk in fileobj.chunks():
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def link_file(source_path, path):
+    """Hardlinks source_path to path, returning False if that isn't possible here"""
+    try:
+        os.link(source_path, path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        return False
+    return True
+
+
+def store_file(fileobj, path, content_hash=None):
+    """Puts the contents of a Django File at path, without copying it if we can avoid it
+
+    Uploads that Django has already written to a temporary file are hardlinked into
+    place. Anything else (in-memory uploads, or a temporary file on another device)
+    is streamed there, a chunk at a time, and hashed on the way. Returns the SHA-1
+    hex digest of the file (or `content_hash`, if that's already known)."""
+    if hasattr(fileobj, "temporary_file_path"):
+        if link_file(fileobj.temporary_file_path(), path):
+            return content_hash or hash_file(fileobj)
+
+    sha1 = hashlib.sha1()
+    with open(path, "wb") as destination:
+        for chunk in fileobj.chunks():
+            sha1.update(chunk)
+            destination.write(chunk)
+    return content_hash or sha1.hexdigest()
+
+
+def draft(img, scale):
+    """Configures a JPEG to be decoded at a reduced size, using libjpeg's DCT scaling
+
+    Since we're going to be resizing the image by `scale` anyway, there's no
+    point in decoding every pixel of it. We always leave at least twice as many
+    pixels as we need, so that the final resize still has something to work with.
+
+    Returns the factor that the image will actually be scaled by (1.0, if no
+    scaling is being done)."""
+    if not settings.BETTY_JPEG_DRAFT_MODE or img.format != "JPEG" or scale <= 0:
+        return 1.0
+
+    reduction = 1.0 / (scale * 2)
+    for factor in (8, 4, 2):
+        if reduction >= factor:
+            break
+    else:
+        return 1.0
+
+    original_size = img.size
+    img.draft(img.mode, (original_size[0] // factor, original_size[1] // factor))
+    return img.size[0] / float(original_size[0])
+
+
+def scale_selection(selection, scale):
+    """Returns a crop box for the selection, in an image that's been scaled by `scale`"""
+    return tuple(
+        int(round(selection[key] * scale)) for key in ('x0', 'y0', 'x1', 'y1')
+    )
+
+
 def optimize_image(image):
 
     im = PILImage.open(image.source.path)
@@ -73,71 +216,219 @@ def optimize_image(image):
                 raise
     else:
         im.save(image.optimized.name, icc_profile=icc_profile)
-    image.save()
+    # Only save the field we changed, since this might be running in a task, while
+    # somebody is editing the image.
+    image.save(update_fields=["optimized"])
+
+
+def save_animated_original(image):
+    """Saves a copy of an animated GIF, along with a JPEG still of its first frame"""
+    os.makedirs(os.path.join(image.path(), "animated"))
+
+    # First, let's copy the original
+    animated_path = os.path.join(image.path(), "animated/original.gif")
+    shutil.copy(image.source.path, animated_path)
+    os.chmod(animated_path, 744)
+
+    # Next, we'll make a thumbnail of the original
+    im = PILImage.open(image.source.path)
+    still_path = os.path.join(image.path(), "animated/original.jpg")
+    if im.mode != "RGB":
+        jpeg = im.convert("RGB")
+        jpeg.save(still_path, "JPEG")
+    else:
+        im.save(still_path, "JPEG")
+
+
+def process_upload(image):
+    """Does the slow part of adding a new image
+
+    This makes the GIF still, optimizes the source, and then kicks off the JPEG
+    quality search and crop warming, if those are turned on. With BETTY_ASYNC_INGEST,
+    this runs in a task, after the image has already been returned to the client."""
+    if image.animated:
+        save_animated_original(image)
+
+    optimize_image(image)
+
+    # Any crops requested before now were made from the source image.
+    image.clear_crops(ratios=list(settings.BETTY_RATIOS) + ["original"])
+
+    if settings.BETTY_JPEG_QUALITY_RANGE:
+        # This warms the crops once it's done, so they get the right quality.
+        search_image_quality.apply_async(args=(image.id,))
+    elif settings.BETTY_WARM_CROPS:
+        warm_crops.apply_async(args=(image.id,))
 
 
 class Ratio(object):
-    def __init__(self, ratio):
-        self.string = ratio
-        self.height = 0
-        self.width = 0
+    """An aspect ratio, parsed from a string like "16x9"
+
+    Ratios are immutable. The "original" ratio takes its width and height from the
+    `size` of the image it's being applied to. Use `Ratio.get` to look up one of
+    the configured ratios without parsing it again."""
 
+    __slots__ = ("string", "width", "height", "aspect")
+
+    _registry = None
+    _registry_ratios = None
+
+    def __init__(self, ratio, size=None):
+        width, height = size or (0, 0)
         if ratio != "original":
             if len(ratio.split("x")) != 2:
                 raise ValueError("Improper ratio!")
-            self.width = int(ratio.split("x")[0])
-            self.height = int(ratio.split("x")[1])
+            width = int(ratio.split("x")[0])
+            height = int(ratio.split("x")[1])
+
+        object.__setattr__(self, "string", ratio)
+        object.__setattr__(self, "width", width)
+        object.__setattr__(self, "height", height)
+        object.__setattr__(self, "aspect", width / float(height) if height else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Ratio objects are immutable")
+
+    def __repr__(self):
+        return "Ratio({0!r})".format(self.string)
+
+    @classmethod
+    def get(cls, ratio_slug):
+        """Returns the Ratio for one of BETTY_RATIOS (or "original"), or None"""
+        if cls._registry_ratios is not settings.BETTY_RATIOS:
+            registry = dict((slug, cls(slug)) for slug in settings.BETTY_RATIOS)
+            registry["original"] = cls("original")
+            cls._registry = registry
+            cls._registry_ratios = settings.BETTY_RATIOS
+        return cls._registry.get(ratio_slug)
 
 
 class ImageManager(models.Manager):
 
+    def get_native(self, image_id):
+        """Returns the serialized data for an image, skipping the database if it's cached"""
+        data = cache.get(self.model(id=image_id).cache_key())
+        if data is None:
+            data = self.get(id=image_id).to_native()
+        return data
+
+    def get_versions(self, image_id):
+        """Returns the version token for each of an image's ratios (and "original")
+
+        These are cached separately from the full image data, since they're checked on
+        every request for a versioned crop URL."""
+        key = self.model(id=image_id).versions_cache_key()
+        versions = cache.get(key)
+        if versions is None:
+            image = self.get(id=image_id)
+            versions = dict(
+                (ratio_slug, image.get_version(ratio_slug))
+                for ratio_slug in list(settings.BETTY_RATIOS) + ["original"]
+            )
+            cache.set(key, versions, NATIVE_CACHE_TIMEOUT)
+        return versions
+
     def create_from_path(self, path, filename=None, name=None, credit=None):
-        """Creates an image object from a TemporaryUploadedFile insance"""
+        """Creates an image object from a file on disk"""
 
-        im = PILImage.open(path)
         if filename is None:
             filename = os.path.split(path)[1]
+        with open(path, "rb") as fileobj:
+            return self.create_from_file(File(fileobj), filename=filename, name=name, credit=credit)
+
+    def create_from_file(self, fileobj, filename=None, name=None, credit=None):
+        """Creates an image object from an UploadedFile (or any other Django File)"""
+
+        if filename is None:
+            filename = os.path.split(fileobj.name)[1]
         if name is None:
             name = filename
 
+        content_hash = None
+        if settings.BETTY_DEDUPE:
+            # We need the hash before storing anything, to look for a duplicate
+            content_hash = hash_file(fileobj)
+            original = self.get_duplicate(content_hash)
+            if original is not None:
+                if settings.BETTY_DEDUPE == "record":
+                    return original
+                return self.create_duplicate(original, filename, name, credit)
+
+        # This only reads the header
+        fileobj.seek(0)
+        im = PILImage.open(fileobj)
+
         image = self.create(
             name=name,
             credit=credit,
             width=im.size[0],
-            height=im.size[1]
+            height=im.size[1],
+            animated=(im.format == "GIF")
+        )
+
+        os.makedirs(image.path())
+
+        source_path = source_upload_to(image, filename)
+        image.content_hash = store_file(fileobj, source_path, content_hash=content_hash)
+        image.source.name = source_path
+        image.save()
+
+        if settings.BETTY_ASYNC_INGEST:
+            # Until this is done, crops get made from the source image.
+            ingest_image.apply_async(args=(image.id,))
+        else:
+            process_upload(image)
+
+        return image
+
+    def get_duplicate(self, content_hash):
+        """Returns the oldest fully processed image with this content hash, if there is one"""
+        for image in self.filter(content_hash=content_hash).order_by("id"):
+            if image.optimized and os.path.exists(image.optimized.path):
+                return image
+        return None
+
+    def create_duplicate(self, original, filename, name, credit):
+        """Creates a new image, sharing the files of an identical, existing one
+
+        The source, optimized and animated files are hardlinked where possible, so
+        the new image takes up no extra space, and needs no optimizing."""
+
+        image = self.create(
+            name=name,
+            credit=credit,
+            width=original.width,
+            height=original.height,
+            animated=original.animated,
+            jpeg_quality=original.jpeg_quality,
+            jpeg_quality_searched=original.jpeg_quality_searched,
+            content_hash=original.content_hash
         )
 
+        def share(source_path, path):
+            if not link_file(source_path, path):
+                shutil.copy(source_path, path)
+
         os.makedirs(image.path())
 
-        # Let's make sure we copy the temp file to the source location
         source_path = source_upload_to(image, filename)
-        shutil.copy(path, source_path)
+        share(original.source.path, source_path)
         image.source.name = source_path
 
-        # If the image is a GIF, we need to do some special stuff
-        if im.format == "GIF":
-            image.animated = True
+        optimized_path = optimized_upload_to(image, original.optimized.name)
+        share(original.optimized.path, optimized_path)
+        image.optimized.name = optimized_path
 
+        if original.animated:
             os.makedirs(os.path.join(image.path(), "animated"))
+            for animated_name in ("animated/original.gif", "animated/original.jpg"):
+                share(os.path.join(original.path(), animated_name),
+                      os.path.join(image.path(), animated_name))
 
-            # First, let's copy the original
-            animated_path = os.path.join(image.path(), "animated/original.gif")
-            shutil.copy(path, animated_path)
-            os.chmod(animated_path, 744)
-            
-            # Next, we'll make a thumbnail of the original
-            still_path = os.path.join(image.path(), "animated/original.jpg")
-            if im.mode != "RGB":
-                jpeg = im.convert("RGB")
-                jpeg.save(still_path, "JPEG")
-            else:
-                im.save(still_path, "JPEG")
-    
         image.save()
-        optimize_image(image)
 
-        if settings.BETTY_JPEG_QUALITY_RANGE:
-            search_image_quality.apply_async(args=(image.id,))
+        if settings.BETTY_WARM_CROPS:
+            warm_crops.apply_async(args=(image.id,))
 
         return image
 
@@ -156,8 +447,13 @@ class Image(models.Model):
     selections = JSONField(null=True, blank=True)
 
     jpeg_quality = models.IntegerField(null=True, blank=True)
+    # Set once the quality search has run, even if it left jpeg_quality unset
+    jpeg_quality_searched = models.BooleanField(default=False)
     animated = models.BooleanField(default=False)
 
+    # SHA-1 of the uploaded file, used to find duplicates
+    content_hash = models.CharField(max_length=40, null=True, blank=True, db_index=True)
+
     objects = ImageManager()
 
     class Meta:
@@ -201,13 +497,17 @@ class Image(models.Model):
         """Returns the image selection for a given ratio
 
         If the selection for this ratio has been set manually, that value
-        is returned exactly, otherwise the selection is auto-generated."""
+        is returned exactly, otherwise the selection is auto-generated.
 
-        # This is kiiiiinda a hack. If we have an optimized image, hack up the height and width.
-        if self.width > settings.BETTY_MAX_WIDTH and self.optimized:
-            height = settings.BETTY_MAX_WIDTH * float(self.height) / float(self.width)
-            self.height = int(round(height))
-            self.width = settings.BETTY_MAX_WIDTH
+        Selections are memoized on the instance until it's saved again."""
+        memo = self.__dict__.setdefault("_selection_cache", {})
+        key = (ratio.string, ratio.width, ratio.height)
+        if key not in memo:
+            memo[key] = self.compute_selection(ratio)
+        return dict(memo[key])
+
+    def compute_selection(self, ratio):
+        self.fix_optimized_size()
 
         selection = None
         if self.selections is not None:
@@ -227,7 +527,7 @@ class Image(models.Model):
 
         if selection is None:
             source_aspect = self.get_width() / float(self.get_height())
-            selection_aspect = ratio.width / float(ratio.height)
+            selection_aspect = ratio.aspect
 
             min_x = 0
             min_y = 0
@@ -272,31 +572,222 @@ class Image(models.Model):
             id_string += char
         return os.path.join(settings.BETTY_IMAGE_ROOT, id_string[1:])
 
-    def crop(self, ratio, width, extension, fp=None):
+    def crop_path(self, ratio_slug, width, extension):
+        """Returns the path where a rendered crop of this image is stored"""
+        return os.path.join(self.path(), ratio_slug, "%d.%s" % (int(width), extension))
+
+    def clear_crops(self, ratios=None):
+        """Deletes the rendered crops for the given ratios (defaults to all ratios)
+
+        Returns a list of the URLs for the crops that were removed, so that any
+        upstream caches can be flushed."""
+        if ratios is None:
+            ratios = settings.BETTY_RATIOS
+
+        urls = []
+        for ratio_slug in ratios:
+            ratio_path = os.path.join(self.path(), ratio_slug)
+            if not os.path.exists(ratio_path):
+                continue
+
+            widths = set()
+            for crop in os.listdir(ratio_path):
+                if crop.startswith("."):
+                    continue  # This is a crop that's still being written
+                width, format = crop.split(".")
+                widths.add(width)
+                urls.append(self.get_absolute_url(
+                    ratio=ratio_slug, width=width, format=format, version=False))
+            if settings.BETTY_AUTO_FORMATS:
+                # ".auto" crops are served from the files above, but cached under their own URL
+                for width in sorted(widths, key=int):
+                    urls.append(self.get_absolute_url(
+                        ratio=ratio_slug, width=width, format="auto", version=False))
+            shutil.rmtree(ratio_path)
+        return urls
+
+    def open_source(self):
+        """Opens the image that crops get made from (the optimized version, if we have one)"""
         if self.optimized:
-            img = PILImage.open(self.optimized.path)
-        else:
-            img = PILImage.open(self.source.path)
-        icc_profile = img.info.get("icc_profile")
+            return PILImage.open(self.optimized.path)
+        return PILImage.open(self.source.path)
+
+    def crop(self, ratio, width, extension, fp=None):
+        img = self.open_source()
+        source_size = img.size
         if ratio.string == 'original':
-            ratio.width = img.size[0]
-            ratio.height = img.size[1]
+            ratio = Ratio('original', size=img.size)
+
+        selection = self.get_selection(ratio)
+        scale = draft(img, width / float(selection['x1'] - selection['x0'] or 1))
+        with metrics.timed("decode", ratio.string, width, extension):
+            img.load()
+        image_blob = self.render_crop(
+            img, ratio, width, extension, scale=scale, source_size=source_size)
+        if is_saved_width(width):
+            crop_path = self.crop_path(ratio.string, width, extension)
+            self.remove_stale_crops({ratio.string: [crop_path]})
+        return image_blob
+
+    def warm_crops(self, ratios=None, widths=None, extensions=None):
+        """Renders and saves crops ahead of time
+
+        Defaults to every configured ratio, width and extension. Widths listed in
+        BETTY_POPULAR_WIDTHS are rendered first."""
+        if ratios is None:
+            ratios = settings.BETTY_RATIOS
+        if widths is None:
+            widths = settings.BETTY_WIDTHS
+        if extensions is None:
+            extensions = settings.BETTY_WARM_EXTENSIONS
+
+        # image.js adds a 0 to BETTY_WIDTHS, which isn't something we can render
+        widths = [width for width in widths if width > 0]
+        targets = [
+            (ratio_slug, width, extension)
+            for ratio_slug in ratios for width in widths for extension in extensions
+        ]
+        if targets:
+            self.render(targets, priority_widths=settings.BETTY_POPULAR_WIDTHS)
+
+    def render(self, targets, priority_widths=()):
+        """Renders a batch of crops, decoding the source image only once
+
+        `targets` is a list of (ratio_slug, width, extension) tuples. Each ratio is
+        cropped once, and then resized from the largest width to the smallest,
+        reusing larger renders where that doesn't cost any quality. Widths in
+        `priority_widths` are saved for every ratio before any of the others. Returns
+        a dict mapping each target to the encoded image data."""
+        img = self.open_source()
+        source_size = img.size
+        icc_profile = img.info.get("icc_profile")
+
+        ratios = OrderedDict()
+        for ratio_slug, width, extension in targets:
+            if ratio_slug not in ratios:
+                if ratio_slug == 'original':
+                    ratio = Ratio('original', size=img.size)
+                else:
+                    ratio = Ratio.get(ratio_slug) or Ratio(ratio_slug)
+                ratios[ratio_slug] = (ratio, {})
+            ratios[ratio_slug][1].setdefault(int(width), []).append(extension)
+
+        max_scale = 0
+        for ratio, widths in ratios.values():
+            selection = self.get_selection(ratio)
+            selection_width = float(selection['x1'] - selection['x0'] or 1)
+            max_scale = max(max_scale, max(widths) / selection_width)
+        scale = draft(img, max_scale)
+        with metrics.timed("decode", None, None, None):
+            img.load()
+
+        results = {}
+        cropped = {}
+        resized = dict((ratio_slug, {}) for ratio_slug in ratios)
+        priority_widths = set(priority_widths)
+        for is_priority in (True, False):
+            for ratio_slug, (ratio, widths) in ratios.items():
+                batch = [width for width in widths if (width in priority_widths) == is_priority]
+                if not batch:
+                    continue
+
+                if ratio_slug not in cropped:
+                    with metrics.timed("crop", ratio_slug, None, None):
+                        cropped[ratio_slug] = self.crop_selection(
+                            img, ratio, scale=scale, source_size=source_size)
+
+                ratio_resized = resized[ratio_slug]
+                for width in sorted(batch, reverse=True):
+                    # Resizing from a larger render is fine, as long as it's at least twice
+                    # the size
+                    base = cropped[ratio_slug]
+                    for larger_width in sorted(ratio_resized):
+                        if larger_width >= width * 2:
+                            base = ratio_resized[larger_width]
+                            break
+                    with metrics.timed("resize", ratio_slug, width, None):
+                        ratio_resized[width] = self.resize_crop(base, ratio, width)
+
+                    for extension in widths[width]:
+                        results[(ratio_slug, width, extension)] = self.save_crop(
+                            ratio_resized[width], ratio, width, extension,
+                            icc_profile=icc_profile)
+
+                if not is_priority:
+                    # This ratio is done, so there's no need to hold on to its images
+                    del cropped[ratio_slug]
+                    resized[ratio_slug] = {}
+
+        self.remove_stale_crops(dict(
+            (ratio_slug, [
+                self.crop_path(ratio_slug, width, extension)
+                for width, extensions in widths.items() if is_saved_width(width)
+                for extension in extensions
+            ])
+            for ratio_slug, (ratio, widths) in ratios.items()
+        ))
+        return results
+
+    def remove_stale_crops(self, written):
+        """Deletes crops we just saved, if the image changed while they were rendering
+
+        `written` maps ratio slugs to the paths saved for them. Changing an image
+        saves it, and then clears its crops, so a crop saved before the change is
+        cleared along with the rest, while one saved after gets caught here."""
+        written = dict((ratio_slug, paths) for ratio_slug, paths in written.items() if paths)
+        if not written:
+            return
+
+        try:
+            current = type(self).objects.get(id=self.id)
+        except self.DoesNotExist:
+            current = None
+
+        for ratio_slug, paths in written.items():
+            if current is not None:
+                if current.get_version(ratio_slug) == self.get_version(ratio_slug):
+                    continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def crop_selection(self, img, ratio, scale=1.0, source_size=None):
+        """Crops an opened source image down to the selection for a ratio
+
+        `scale` is the factor the source has been reduced by while decoding (see
+        `draft`)."""
+        if source_size is None:
+            source_size = img.size
 
         selection = self.get_selection(ratio)
         try:
-            img = img.crop((selection['x0'], selection['y0'], selection['x1'], selection['y1']))
+            return img.crop(scale_selection(selection, scale))
         except ValueError:
             # Looks like we have bad height and width data. Let's reload that and try again.
-            self.width = img.size[0]
-            self.height = img.size[1]
+            self.width = source_size[0]
+            self.height = source_size[1]
             self.save()
 
             selection = self.get_selection(ratio)
-            img = img.crop((selection['x0'], selection['y0'], selection['x1'], selection['y1']))
+            return img.crop(scale_selection(selection, scale))
 
+    def resize_crop(self, img, ratio, width):
         height = int(round(width * float(ratio.height) / float(ratio.width)))
-        img = img.resize((width, height), PILImage.ANTIALIAS)
+        return img.resize((width, height), PILImage.ANTIALIAS)
 
+    def render_crop(self, img, ratio, width, extension, scale=1.0, source_size=None):
+        """Crops, resizes and encodes an already opened source image"""
+        icc_profile = img.info.get("icc_profile")
+        with metrics.timed("crop", ratio.string, width, extension):
+            img = self.crop_selection(img, ratio, scale=scale, source_size=source_size)
+        with metrics.timed("resize", ratio.string, width, extension):
+            img = self.resize_crop(img, ratio, width)
+        return self.save_crop(img, ratio, width, extension, icc_profile=icc_profile)
+
+    def save_crop(self, img, ratio, width, extension, icc_profile=None):
+        """Encodes a rendered crop, saving it to disk if it's one of our usual widths"""
         if extension == "jpg":
             if img.mode != "RGB":
                 img = img.convert("RGB")
@@ -307,47 +798,97 @@ class Image(models.Model):
                 pillow_kwargs["quality"] = "keep"
             else:
                 pillow_kwargs["quality"] = settings.BETTY_DEFAULT_JPEG_QUALITY
+            pillow_kwargs.update(jpeg_encoder_profile(width))
 
-        if extension == "png":
+        elif extension == "png":
             pillow_kwargs = {"format": "png"}
 
+        elif extension in ("webp", "avif"):
+            # Only keep an alpha channel if there's something in it, since it costs bytes
+            if "A" in img.mode or "transparency" in img.info:
+                mode = "RGBA"
+            else:
+                mode = "RGB"
+            if img.mode != mode:
+                img = img.convert(mode)
+            pillow_kwargs = {"format": extension}
+            if extension == "webp":
+                pillow_kwargs["quality"] = settings.BETTY_WEBP_QUALITY
+            else:
+                pillow_kwargs["quality"] = settings.BETTY_AVIF_QUALITY
+
         if icc_profile:
             pillow_kwargs["icc_profile"] = icc_profile
 
-        if width in settings.BETTY_WIDTHS or len(settings.BETTY_WIDTHS) == 0:
-            ratio_dir = os.path.join(self.path(), ratio.string)
-            # We only want to save this to the filesystem if it's one of our usual widths.
-            try:
-                os.makedirs(ratio_dir)
-            except OSError as e:
-                if e.errno != 17:
-                    raise e
+        tmp = io.BytesIO()
+        with metrics.timed("encode", ratio.string, width, extension):
+            img.save(tmp, **pillow_kwargs)
+        image_blob = tmp.getvalue()
 
-            with open(os.path.join(ratio_dir, "%d.%s" % (width, extension)), 'wb+') as out:
-                img.save(out, **pillow_kwargs)
+        if is_saved_width(width):
+            with metrics.timed("write", ratio.string, width, extension):
+                atomic_write(self.crop_path(ratio.string, width, extension), image_blob)
 
-        tmp = io.BytesIO()
-        img.save(tmp, **pillow_kwargs)
+        return image_blob
 
-        return tmp.getvalue()
+    def get_absolute_url(self, ratio="original", width=600, format="jpg", version=None):
+        """Returns the URL for a crop
 
-    def get_absolute_url(self, ratio="original", width=600, format="jpg"):
-        return reverse("betty.cropper.views.crop", kwargs={
+        With BETTY_VERSIONED_URLS on, the URL carries the ratio's current version
+        (see `get_version`), unless `version` is False."""
+        url = reverse("betty.cropper.views.crop", kwargs={
             "id": self.id_string,
             "ratio_slug": ratio,
             "width": width,
             "extension": format
         })
+        if version is None and settings.BETTY_VERSIONED_URLS:
+            version = self.get_version(ratio)
+        if version:
+            url += "?v={0}".format(version)
+        return url
+
+    def get_version(self, ratio_slug):
+        """Returns a short token that changes whenever the crops for a ratio would change"""
+        self.fix_optimized_size()
+        ratio = Ratio.get(ratio_slug)
+        if ratio is None or ratio.string == "original":
+            selection = [self.width, self.height]
+        else:
+            selection = self.get_selection(ratio)
+            selection = [selection[key] for key in ("x0", "y0", "x1", "y1")]
+        # An unsaved name is None, but comes back from the database as ""
+        data = json.dumps([selection, self.jpeg_quality, self.optimized.name or ""])
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()[:8]
+
+    def to_native(self, fields=None):
+        """Returns a Python dictionary, sutiable for Serialization
+
+        The full data is cached under `cache_key()` until the image is saved again.
+        If `fields` is given, only those keys are included. Leaving out "selections"
+        skips computing them, and uses the stored width and height as-is."""
+
+        if fields is None or "selections" in fields:
+            data = cache.get(self.cache_key())
+            if data is None:
+                data = self.serialize()
+                cache.set(self.cache_key(), data, NATIVE_CACHE_TIMEOUT)
+        else:
+            self.fix_optimized_size()
+            data = {
+                'id': self.id,
+                'name': self.name,
+                'width': self.width,
+                'height': self.height,
+                'credit': self.credit,
+            }
 
-    def to_native(self):
-        """Returns a Python dictionary, sutiable for Serialization"""
-        
-        # This is kiiiiinda a hack. If we have an optimized image, hack up the height and width.
-        if self.width > settings.BETTY_MAX_WIDTH and self.optimized:
-            height = settings.BETTY_MAX_WIDTH * float(self.height) / float(self.width)
-            self.height = int(round(height))
-            self.width = settings.BETTY_MAX_WIDTH
-        
+        if fields is not None:
+            data = dict((field, data[field]) for field in fields if field in data)
+        return data
+
+    def serialize(self):
+        self.fix_optimized_size()
         data = {
             'id': self.id,
             'name': self.name,
@@ -357,14 +898,40 @@ class Image(models.Model):
             'selections': {}
         }
         for ratio in settings.BETTY_RATIOS:
-            data['selections'][ratio] = self.get_selection(Ratio(ratio))
-            data['selections'][ratio]["source"] = "auto"
-            if self.selections and data['selections'][ratio] == self.selections.get(ratio):
-                data['selections'][ratio]["source"] = "user"
+            selection = self.get_selection(Ratio.get(ratio))
+            source = "auto"
+            if self.selections and selection == self.selections.get(ratio):
+                source = "user"
+            selection["source"] = source
+            selection["version"] = self.get_version(ratio)
+            data['selections'][ratio] = selection
         return data
 
+    def fix_optimized_size(self):
+        # This is kiiiiinda a hack. If we have an optimized image, hack up the height and width.
+        if self.optimized:
+            self.scale_to_max_width()
+
+    def scale_to_max_width(self):
+        """Shrinks the stored size to match the optimized image (at most BETTY_MAX_WIDTH wide)"""
+        if self.width > settings.BETTY_MAX_WIDTH:
+            height = settings.BETTY_MAX_WIDTH * float(self.height) / float(self.width)
+            self.height = int(round(height))
+            self.width = settings.BETTY_MAX_WIDTH
+
     def cache_key(self):
         """
         Returns string unique to cache instance
         """
         return "image-{}".format(self.id)
+
+    def versions_cache_key(self):
+        return "image-{}-versions".format(self.id)
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def clear_image_cache(sender, instance, **kwargs):
+    instance.__dict__.pop("_selection_cache", None)
+    cache.delete(instance.cache_key())
+    cache.delete(instance.versions_cache_key())
@@ -0,0 +1,138 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from betty.conf.app import settings
+
+
+def get_terms(query):
+    """Splits a search query into words, dropping any punctuation"""
+    return re.findall(r"\w+", query.lower(), re.UNICODE)
+
+
+class SearchBackend(object):
+    """Base class for image search backends
+
+    Backends filter an Image queryset down to the images matching a query, and
+    order the results by relevance."""
+
+    def search(self, queryset, query):
+        raise NotImplementedError()
+
+    def build_index(self):
+        """Creates (or re-creates) whatever index this backend searches against"""
+        pass
+
+
+class SimpleSearchBackend(SearchBackend):
+    """Searches the name and credit with LIKE queries. Needs no index, but is slow."""
+
+    def search(self, queryset, query):
+        for term in get_terms(query):
+            queryset = queryset.filter(Q(name__icontains=term) | Q(credit__icontains=term))
+        return queryset.order_by("-id")
+
+
+class DatabaseSearchBackend(SimpleSearchBackend):
+    """Full text search over the name and credit, using the database's own indexes
+
+    On Postgres, this uses a GIN index over a tsvector, and ranks the results. On
+    SQLite, it uses an FTS4 table (kept in sync with triggers), and returns the
+    newest matches first. Until the index has been built with the
+    `rebuild_search_index` command, SQLite falls back to LIKE queries, as do any
+    other databases."""
+
+    TSVECTOR = (
+        "to_tsvector('simple', coalesce({table}.name, '') || ' ' || coalesce({table}.credit, ''))"
+    )
+
+    @property
+    def table(self):
+        from betty.cropper.models import Image
+        return Image._meta.db_table
+
+    @property
+    def index_name(self):
+        return "{0}_search".format(self.table)
+
+    def search(self, queryset, query):
+        terms = get_terms(query)
+        if not terms:
+            return queryset.order_by("-id")
+
+        if connection.vendor == "postgresql":
+            return self.search_postgres(queryset, terms)
+        if connection.vendor == "sqlite" and self.sqlite_index_exists():
+            return self.search_sqlite(queryset, terms)
+        return super(DatabaseSearchBackend, self).search(queryset, query)
+
+    def search_postgres(self, queryset, terms):
+        tsvector = self.TSVECTOR.format(table=self.table)
+        tsquery = " & ".join("{0}:*".format(term) for term in terms)
+        return queryset.extra(
+            select={"search_rank": "ts_rank({0}, to_tsquery('simple', %s))".format(tsvector)},
+            select_params=[tsquery],
+            where=["{0} @@ to_tsquery('simple', %s)".format(tsvector)],
+            params=[tsquery],
+        ).order_by("-search_rank", "-id")
+
+    def search_sqlite(self, queryset, terms):
+        match = " ".join("{0}*".format(term) for term in terms)
+        return queryset.extra(
+            where=["{table}.id IN (SELECT docid FROM {index} WHERE {index} MATCH %s)".format(
+                table=self.table, index=self.index_name)],
+            params=[match],
+        ).order_by("-id")
+
+    def sqlite_index_exists(self):
+        return self.index_name in connection.introspection.table_names()
+
+    def build_index(self):
+        if connection.vendor == "postgresql":
+            self.build_postgres_index()
+        elif connection.vendor == "sqlite":
+            self.build_sqlite_index()
+
+    def build_postgres_index(self):
+        cursor = connection.cursor()
+        cursor.execute("DROP INDEX IF EXISTS {0}".format(self.index_name))
+        cursor.execute("CREATE INDEX {0} ON {1} USING gin ({2})".format(
+            self.index_name, self.table, self.TSVECTOR.format(table=self.table)))
+
+    def build_sqlite_index(self):
+        table, index = self.table, self.index_name
+        cursor = connection.cursor()
+        for trigger in ("bu", "bd", "au", "ai"):
+            cursor.execute("DROP TRIGGER IF EXISTS {0}_{1}".format(index, trigger))
+        cursor.execute("DROP TABLE IF EXISTS {0}".format(index))
+
+        cursor.execute(
+            "CREATE VIRTUAL TABLE {index} USING fts4(content=\"{table}\", name, credit)".format(
+                index=index, table=table))
+        cursor.execute("INSERT INTO {index}({index}) VALUES('rebuild')".format(index=index))
+
+        # These keep the index in sync with the image table
+        delete = "DELETE FROM {index} WHERE docid=old.rowid;".format(index=index)
+        insert = "INSERT INTO {index}(docid, name, credit) VALUES(new.rowid, new.name, new.credit);"
+        insert = insert.format(index=index)
+        for trigger, when, statement in (
+                ("bu", "BEFORE UPDATE", delete),
+                ("bd", "BEFORE DELETE", delete),
+                ("au", "AFTER UPDATE", insert),
+                ("ai", "AFTER INSERT", insert)):
+            cursor.execute(
+                "CREATE TRIGGER {index}_{trigger} {when} ON {table} BEGIN {statement} END".format(
+                    index=index, trigger=trigger, when=when, table=table, statement=statement))
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """Returns an instance of the backend configured by BETTY_SEARCH_BACKEND"""
+    path = settings.BETTY_SEARCH_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
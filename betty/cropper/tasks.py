@@ -1,37 +1,114 @@
 from __future__ import absolute_import
 
-import itertools
+import io
 import os
-import tempfile
+from multiprocessing.pool import ThreadPool
 
 from celery import shared_task
 from PIL import Image as PILImage
+from PIL import ImageChops
 
 from betty.conf.app import settings
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-@shared_task
-def search_image_quality(image_id):
 
-    from betty.cropper.models import Image
-    COLOR_DENSITY_RATIO = 0.11
+COLOR_DENSITY_RATIO = 0.11
+
+# Squares of every possible difference between two 8-bit color values
+SQUARES = [value ** 2 for value in range(256)]
+
 
-    def get_color_density(im):
-        area = im.size[0] * im.size[1]
-        unique_colors = len(filter(None, im.histogram()))
-        return unique_colors / float(area)
+def get_color_density(im):
+    area = im.size[0] * im.size[1]
+    unique_colors = len([count for count in im.histogram() if count])
+    return unique_colors / float(area)
 
-    def get_error(a, b):
-        assert a.size == b.size
+
+def get_error(a, b):
+    """Returns the mean euclidean distance between the colors of each pixel in a and b"""
+    assert a.size == b.size
+    if numpy is not None:
+        difference = numpy.asarray(a, dtype=numpy.float64) - numpy.asarray(b, dtype=numpy.float64)
+        if difference.ndim == 2:
+            return float(numpy.abs(difference).mean())
+        return float(numpy.sqrt((difference ** 2).sum(axis=2)).mean())
+
+    difference_im = ImageChops.difference(a, b)
+    if len(difference_im.getbands()) == 1:
+        # Single band images (like "L") have plain ints for pixels
+        difference = sum(difference_im.getdata())
+    else:
         difference = 0
-        for color_sets in itertools.izip(a.getdata(), b.getdata()):
-            distance = 0
-            for color_pair in zip(color_sets[0], color_sets[1]):
-                distance += ((color_pair[0] - color_pair[1]) ** 2)
-            difference += (distance ** 0.5)
+        for color_set in difference_im.getdata():
+            difference += sum(SQUARES[value] for value in color_set) ** 0.5
+
+    pixel_error = difference / float(b.size[0] * b.size[1])
+    return pixel_error
+
+
+def get_midpoint(search_range):
+    return int(round(search_range[0] + (search_range[1] - search_range[0]) / 2.0))
+
+
+def get_candidates(search_range, count, known=()):
+    """Returns up to `count` qualities the binary search could probe next
+
+    Nearer levels of the search come first, and qualities in `known` are skipped."""
+    candidates = []
+    ranges = [search_range]
+    while ranges and len(candidates) < count:
+        next_ranges = []
+        for low, high in ranges:
+            if high - low <= 1:
+                continue
+            quality = get_midpoint((low, high))
+            if quality not in known:
+                candidates.append(quality)
+            next_ranges.extend([(quality, high), (low, quality)])
+        ranges = next_ranges
+    return candidates[:count]
+
+
+def search_quality(is_acceptable, search_range, threads=1):
+    """Binary searches search_range for the lowest acceptable quality
+
+    With more than one thread, each round probes the next midpoint along with as
+    many of the qualities the following steps could need as there are spare
+    threads, and the search then walks those results exactly as the sequential
+    version would, so the answer doesn't depend on the thread count."""
+    pool = ThreadPool(threads) if threads > 1 else None
+
+    results = {}
+    try:
+        while (search_range[1] - search_range[0]) > 1:
+            quality = get_midpoint(search_range)
+            if quality not in results:
+                candidates = get_candidates(search_range, threads, results)
+                if pool is not None:
+                    results.update(zip(candidates, pool.map(is_acceptable, candidates)))
+                else:
+                    results.update(
+                        (candidate, is_acceptable(candidate)) for candidate in candidates)
+
+            if results[quality]:
+                search_range = (search_range[0], quality)
+            else:
+                search_range = (quality, search_range[1])
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return search_range[1]
 
-        pixel_error = difference / float(b.size[0] * b.size[1])
-        return pixel_error
+
+@shared_task
+def search_image_quality(image_id):
+
+    from betty.cropper.models import Image
 
     def is_optimized(image):
         """Checks if the image is already optimized
@@ -39,19 +116,23 @@ def search_image_quality(image_id):
         For our purposes, we check to see if the existing file will be smaller than
         a version saved at the default quality (80)."""
 
-        im = PILImage.open(image.source.path)
+        with open(image.source.path, "rb") as source:
+            im = PILImage.open(source)
+            if im.format != "JPEG":
+                return False
+            im.load()
         icc_profile = im.info.get("icc_profile")
 
         # First, let's check to make sure that this image isn't already an optimized JPEG
         if im.format == "JPEG":
-            optimized_path = tempfile.mkstemp()[1]
+            optimized = io.BytesIO()
             im.save(
-                optimized_path,
+                optimized,
                 format="JPEG",
                 quality=settings.BETTY_DEFAULT_JPEG_QUALITY,
                 icc_profile=icc_profile,
                 optimize=True)
-            if os.stat(image.source.path).st_size < os.stat(optimized_path).st_size:
+            if os.stat(image.source.path).st_size < len(optimized.getvalue()):
                 # Looks like the original was already compressed, let's bail.
                 return True
         
@@ -60,10 +141,16 @@ def search_image_quality(image_id):
     image = Image.objects.get(id=image_id)
     
     if is_optimized(image):
+        # Already smaller than we'd make it, so crops keep the default quality.
+        image.jpeg_quality_searched = True
+        image.save(update_fields=["jpeg_quality_searched"])
+        if settings.BETTY_WARM_CROPS:
+            warm_crops.apply_async(args=(image.id,))
         return
 
-    im = PILImage.open(image.optimized.path)
-    search_im = im.copy()
+    with open(image.optimized.path, "rb") as optimized:
+        im = PILImage.open(optimized)
+        search_im = im.copy()
 
     area = search_im.size[0] * search_im.size[1]
     max_area = (1000.0 * 1000.0)
@@ -77,23 +164,84 @@ def search_image_quality(image_id):
     original_density = get_color_density(search_im)
     icc_profile = im.info.get("icc_profile")
 
-    search_range = settings.BETTY_JPEG_QUALITY_RANGE
+    def is_acceptable(quality):
+        # Pillow keeps the save options on the image object, so each probe needs its own
+        # copy when they run in parallel.
+        probe_im = search_im.copy()
+        output = io.BytesIO()
+        probe_im.save(output, "jpeg", quality=quality, icc_profile=icc_profile, optimize=True)
+        output.seek(0)
+        saved = PILImage.open(output)
+
+        pixel_error = get_error(saved, probe_im)
+        density_ratio = (get_color_density(saved) - original_density) / original_density
 
-    while (search_range[1] - search_range[0]) > 1:
-        quality = int(round(search_range[0] + (search_range[1] - search_range[0]) / 2.0))
+        return pixel_error <= settings.BETTY_JPEG_MAX_ERROR and density_ratio <= COLOR_DENSITY_RATIO
 
-        output_filepath = tempfile.mkstemp()[1]
-        search_im.save(output_filepath, "jpeg", quality=quality, icc_profile=icc_profile, optimize=True)
-        saved = PILImage.open(output_filepath)
+    image.jpeg_quality = search_quality(
+        is_acceptable,
+        settings.BETTY_JPEG_QUALITY_RANGE,
+        threads=settings.BETTY_JPEG_QUALITY_SEARCH_THREADS
+    )
+    image.jpeg_quality_searched = True
+    image.save(update_fields=["jpeg_quality", "jpeg_quality_searched"])
+
+    # Any crops rendered before now were encoded at the default quality.
+    image.clear_crops(ratios=list(settings.BETTY_RATIOS) + ["original"])
+
+    if settings.BETTY_WARM_CROPS:
+        warm_crops.apply_async(args=(image.id,))
 
-        pixel_error = get_error(saved, search_im)
-        density_ratio = (get_color_density(saved) - original_density) / original_density
 
-        if pixel_error > settings.BETTY_JPEG_MAX_ERROR or density_ratio > COLOR_DENSITY_RATIO:
-            search_range = (quality, search_range[1])
-        else:
-            search_range = (search_range[0], quality)
-        os.remove(output_filepath)
+@shared_task
+def ingest_image(image_id):
+    """Optimizes a newly uploaded image, when BETTY_ASYNC_INGEST is on"""
+
+    from betty.cropper.models import Image, process_upload
+
+    image = Image.objects.get(id=image_id)
+    process_upload(image)
+
+
+@shared_task
+def warm_crops(image_id, ratios=None):
+    """Pre-renders the crops for an image, so that the first viewer doesn't have to wait"""
+
+    from betty.cropper.models import Image
+
+    try:
+        image = Image.objects.get(id=image_id)
+    except Image.DoesNotExist:
+        return
+    image.warm_crops(ratios=ratios)
+
+
+@shared_task(bind=True)
+def flush_cache(self, urls):
+    """Purges crop URLs from upstream caches, using BETTY_CACHE_FLUSHER
+
+    With BETTY_CACHE_FLUSHER_BATCH_SIZE set, the flusher gets called with lists of up
+    to that many URLs, instead of once per URL. If the flusher fails, the URLs that
+    haven't been flushed yet are retried with exponential backoff."""
+
+    flusher = settings.BETTY_CACHE_FLUSHER
+    if not flusher:
+        return
 
-    image.jpeg_quality = search_range[1]
-    image.save()
+    batch_size = settings.BETTY_CACHE_FLUSHER_BATCH_SIZE
+    flushed = 0
+    try:
+        while flushed < len(urls):
+            if batch_size:
+                flusher(urls[flushed:flushed + batch_size])
+                flushed += batch_size
+            else:
+                flusher(urls[flushed])
+                flushed += 1
+    except Exception as e:
+        raise self.retry(
+            args=(urls[flushed:],),
+            exc=e,
+            countdown=2 ** self.request.retries,
+            max_retries=settings.BETTY_CACHE_FLUSHER_RETRIES
+        )
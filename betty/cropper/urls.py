@@ -1,14 +1,13 @@
 from django.conf.urls import patterns, url, include
 
-urlpatterns = patterns('betty.cropper.views',
+# Ends every crop URL, e.g. "1x1/240.jpg"
+CROP_PATH = r'(?P<ratio_slug>[a-z0-9]+)/(?P<width>\d+)\.(?P<extension>(jpg|png|webp|avif|auto))'
+
+urlpatterns = patterns(
+    'betty.cropper.views',
     url(r'image\.js', "image_js"),
-    url(  # noqa
-        r'^(?P<id>\d{5,})/(?P<ratio_slug>[a-z0-9]+)/(?P<width>\d+)\.(?P<extension>(jpg|png))',
-        'redirect_crop'
-    ),
-    url(  # noqa
-        r'^(?P<id>[0-9/]+)/(?P<ratio_slug>[a-z0-9]+)/(?P<width>\d+)\.(?P<extension>(jpg|png))',
-        'crop'
-    ),
+    url(r'^metrics$', "metrics_view"),
+    url(r'^(?P<id>\d{5,})/' + CROP_PATH, 'redirect_crop'),
+    url(r'^(?P<id>[0-9/]+)/' + CROP_PATH, 'crop'),
     url(r'api/', include("betty.cropper.api.urls")),
 )
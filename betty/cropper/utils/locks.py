@@ -0,0 +1,88 @@
+import errno
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # No cross-process locking on this platform, just threads.
+
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextmanager
+def thread_lock(key):
+    """Holds a lock for `key`, shared by every thread in this process"""
+    with _thread_locks_lock:
+        lock, waiting = _thread_locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _thread_locks[key] = (lock, waiting + 1)
+
+    try:
+        with lock:
+            yield
+    finally:
+        with _thread_locks_lock:
+            lock, waiting = _thread_locks[key]
+            if waiting == 1:
+                del _thread_locks[key]
+            else:
+                _thread_locks[key] = (lock, waiting - 1)
+
+
+def _acquire_file_lock(lock_path):
+    while True:
+        try:
+            os.makedirs(os.path.dirname(lock_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        # Whoever held the lock before us deletes the file on the way out, in which
+        # case we've locked a file nobody else can see, and need to try again.
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                os.close(fd)
+                raise
+        os.close(fd)
+
+
+@contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on `path`, across every process on this machine
+
+    The lock itself is a hidden file next to `path`, which is removed again once
+    the lock is released."""
+    if fcntl is None:
+        yield
+        return
+
+    directory, filename = os.path.split(path)
+    lock_path = os.path.join(directory, ".{0}.lock".format(filename))
+    fd = _acquire_file_lock(lock_path)
+    try:
+        yield
+    finally:
+        try:
+            os.unlink(lock_path)
+        except OSError:
+            pass
+        os.close(fd)
+
+
+@contextmanager
+def render_lock(path):
+    """Makes sure that only one thread or process at a time renders the file at `path`"""
+    with thread_lock(path):
+        with file_lock(path):
+            yield
@@ -1,5 +1,7 @@
 import io
-import random
+import threading
+import zlib
+from collections import OrderedDict
 
 from PIL import Image, ImageDraw, ImageFont
 
@@ -7,17 +9,55 @@ from betty.cropper.models import Ratio
 from betty.conf.app import settings
 
 
+_fonts = {}
+
+# Encoded placeholders, least recently used first
+_placeholders = OrderedDict()
+_placeholders_lock = threading.Lock()
+
+
+def get_font():
+    """Returns the placeholder font, which only gets loaded once per process"""
+    path = settings.BETTY_PLACEHOLDER_FONT
+    if path not in _fonts:
+        _fonts[path] = ImageFont.truetype(filename=path, size=45)
+    return _fonts[path]
+
+
+def choose(options, *key):
+    """Picks one of the options, always the same one for a given key"""
+    digest = zlib.crc32(":".join(str(part) for part in key).encode("utf-8")) & 0xffffffff
+    return options[digest % len(options)]
+
+
 def placeholder(ratio, width, extension):
     if ratio.string == "original":
-        ratio = Ratio(random.choice((settings.BETTY_RATIOS)))
+        ratio = Ratio.get(choose(settings.BETTY_RATIOS, width))
+    bg_fill = tuple(choose(settings.BETTY_PLACEHOLDER_COLORS, ratio.string, width))
+
+    key = (ratio.string, width, extension, bg_fill)
+    with _placeholders_lock:
+        if key in _placeholders:
+            _placeholders[key] = _placeholders.pop(key)
+            return _placeholders[key]
+
+    image_blob = render_placeholder(ratio, width, extension, bg_fill)
+
+    with _placeholders_lock:
+        _placeholders[key] = image_blob
+        while len(_placeholders) > settings.BETTY_PLACEHOLDER_CACHE_SIZE:
+            _placeholders.popitem(last=False)
+    return image_blob
+
+
+def render_placeholder(ratio, width, extension, bg_fill):
     height = int(round((width * ratio.height / float(ratio.width))))
 
-    bg_fill = random.choice(settings.BETTY_PLACEHOLDER_COLORS)
     img = Image.new("RGB", (width, height), bg_fill)
 
     draw = ImageDraw.Draw(img)
 
-    font = ImageFont.truetype(filename=settings.BETTY_PLACEHOLDER_FONT, size=45)
+    font = get_font()
     text_size = draw.textsize(ratio.string, font=font)
     text_coords = (
         int(round((width - text_size[0]) / 2.0)),
@@ -26,8 +66,8 @@ def placeholder(ratio, width, extension):
     draw.text(text_coords, ratio.string, font=font, fill=(256, 256, 256))
     if extension == 'jpg':
         pillow_kwargs = {"format": "jpeg", "quality": 80}
-    if extension == 'png':
-        pillow_kwargs = {"format": "png"}
+    else:
+        pillow_kwargs = {"format": extension}
 
     tmp = io.BytesIO()
     img.save(tmp, **pillow_kwargs)
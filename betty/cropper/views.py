@@ -1,12 +1,28 @@
+import hashlib
 import json
+import os
+from functools import wraps
+from wsgiref.util import FileWrapper
+
 from betty.conf.app import settings
 
-from django.http import Http404, HttpResponse, HttpResponseServerError, HttpResponseRedirect
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseNotModified,
+    HttpResponseServerError,
+    HttpResponseRedirect,
+    StreamingHttpResponse
+)
 from django.shortcuts import render
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
 from django.views.decorators.cache import cache_control
 from six.moves import urllib
 
-from .models import Image, Ratio
+from . import metrics
+from .models import Image, Ratio, can_encode, encoder_signature, is_saved_width
+from .utils.locks import render_lock
 from .utils.placeholder import placeholder
 
 EXTENSION_MAP = {
@@ -18,8 +34,46 @@ EXTENSION_MAP = {
         "format": "png",
         "mime_type": "image/png"
     },
+    "webp": {
+        "format": "webp",
+        "mime_type": "image/webp"
+    },
+    "avif": {
+        "format": "avif",
+        "mime_type": "image/avif"
+    },
 }
 
+# Only offer the formats this build of Pillow can actually write
+EXTENSION_MAP = dict(
+    (extension, info) for extension, info in EXTENSION_MAP.items() if can_encode(info["format"])
+)
+
+
+def accepts(request, mime_type):
+    """Checks if the request's Accept header allows the given type"""
+    for accepted in request.META.get("HTTP_ACCEPT", "").split(","):
+        params = accepted.strip().split(";")
+        if params[0].strip() != mime_type:
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def negotiate_extension(request):
+    """Picks the first of BETTY_AUTO_FORMATS that the client accepts, falling back to JPEG"""
+    for extension in settings.BETTY_AUTO_FORMATS:
+        if extension in EXTENSION_MAP and accepts(request, EXTENSION_MAP[extension]["mime_type"]):
+            return extension
+    return "jpg"
+
 
 @cache_control(max_age=300)
 def image_js(request):
@@ -39,11 +93,8 @@ def image_js(request):
         "BETTY_WIDTHS": sorted(widths),
         "BETTY_MAX_WIDTH": settings.BETTY_MAX_WIDTH
     }
-    BETTY_RATIOS = []
-    ratios_sorted = sorted(settings.BETTY_RATIOS, key=lambda r: Ratio(r).width / float(Ratio(r).height))
-    for ratio_string in ratios_sorted:
-        ratio = Ratio(ratio_string)
-        BETTY_RATIOS.append((ratio_string, ratio.width / float(ratio.height)))
+    ratios = sorted((Ratio.get(r) for r in settings.BETTY_RATIOS), key=lambda r: r.aspect)
+    BETTY_RATIOS = [(ratio.string, ratio.aspect) for ratio in ratios]
     context["BETTY_RATIOS"] = json.dumps(BETTY_RATIOS)
 
     return render(request, "image.js", context, content_type="application/javascript")
@@ -59,17 +110,126 @@ def redirect_crop(request, id, ratio_slug, width, extension):
     """
     image = Image(id=image_id)
 
-    return HttpResponseRedirect(image.get_absolute_url(ratio=ratio_slug, width=width, format=extension))
+    url = image.get_absolute_url(
+        ratio=ratio_slug, width=width, format=extension, version=request.GET.get("v", False))
+    return HttpResponseRedirect(url)
 
 
-@cache_control(max_age=300)
-def crop(request, id, ratio_slug, width, extension):
-    if ratio_slug != "original" and ratio_slug not in settings.BETTY_RATIOS:
-        raise Http404
+def is_current_version(image_id, ratio_slug, version):
+    """Checks a version token against the image's current version for a ratio
 
+    This uses the cached version tokens where it can, so it usually skips the database."""
     try:
-        ratio = Ratio(ratio_slug)
-    except ValueError:
+        return Image.objects.get_versions(image_id).get(ratio_slug) == version
+    except Image.DoesNotExist:
+        return False
+
+
+def crop_cache_control(view):
+    """Like cache_control(max_age=300), except that crops requested with their current
+    version token (from Image.get_version) can be cached for BETTY_VERSIONED_CACHE_MAX_AGE,
+    since any change to them changes the URL"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        resp = view(request, *args, **kwargs)
+        versioned = (
+            request.GET.get("v") and
+            settings.BETTY_VERSIONED_CACHE_MAX_AGE and
+            resp.status_code in (200, 304) and
+            not resp.has_header("Cache-Control") and  # Placeholders set their own
+            is_current_version(
+                int(kwargs["id"].replace("/", "")), kwargs["ratio_slug"], request.GET["v"])
+        )
+        if versioned:
+            patch_cache_control(
+                resp, public=True, max_age=settings.BETTY_VERSIONED_CACHE_MAX_AGE, immutable=True)
+        else:
+            patch_cache_control(resp, max_age=300)
+        return resp
+    return wrapper
+
+
+def crop_etag(image_id, version, ratio_slug, width, extension):
+    """Returns a strong ETag for a crop, covering everything that goes into rendering it
+
+    `version` identifies the state of the image (or of the rendered file)."""
+    key = ":".join(str(part) for part in (
+        image_id, version, ratio_slug, width, extension, encoder_signature(extension, width)
+    ))
+    return quote_etag(hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def file_validators(image_id, stat, ratio_slug, width, extension):
+    """Returns the ETag and Last-Modified time for a crop rendered to disk"""
+    version = "{0}-{1}-{2}".format(stat.st_ino, stat.st_size, stat.st_mtime)
+    return crop_etag(image_id, version, ratio_slug, width, extension), stat.st_mtime
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """Checks the request's If-None-Match (or failing that, If-Modified-Since) header"""
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        etags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in etags or etag in etags or "W/" + etag in etags
+
+    if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    if if_modified_since is not None and last_modified is not None:
+        return int(last_modified) <= if_modified_since
+    return False
+
+
+def set_validators(resp, etag, last_modified=None):
+    resp["ETag"] = etag
+    if last_modified is not None:
+        resp["Last-Modified"] = http_date(last_modified)
+    return resp
+
+
+def rendered_crop_response(request, path, image_id, ratio_slug, width, extension):
+    """Returns a response for a crop that has already been rendered to disk
+
+    If the crop hasn't been rendered yet, this returns None. Conditional requests are
+    answered from the file's metadata, without opening it. If BETTY_SENDFILE_HEADER
+    is set, the actual file transfer is handed off to the web server."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    etag, last_modified = file_validators(image_id, stat, ratio_slug, width, extension)
+    if is_not_modified(request, etag, last_modified):
+        metrics.record_request("not_modified", ratio_slug, width, extension)
+        return set_validators(HttpResponseNotModified(), etag, last_modified)
+
+    try:
+        fp = open(path, "rb")
+    except IOError:
+        return None
+
+    # The file might have been re-rendered since we looked at it
+    stat = os.fstat(fp.fileno())
+    etag, last_modified = file_validators(image_id, stat, ratio_slug, width, extension)
+    metrics.record_request("hit", ratio_slug, width, extension, size=stat.st_size)
+
+    if settings.BETTY_SENDFILE_HEADER:
+        fp.close()
+        resp = HttpResponse()
+        sendfile_path = path
+        if settings.BETTY_SENDFILE_ROOT:
+            relative_path = os.path.relpath(path, settings.BETTY_IMAGE_ROOT)
+            sendfile_path = os.path.join(settings.BETTY_SENDFILE_ROOT, relative_path)
+        resp[settings.BETTY_SENDFILE_HEADER] = sendfile_path
+    else:
+        resp = StreamingHttpResponse(FileWrapper(fp))
+        resp["Content-Length"] = stat.st_size
+    resp["Content-Type"] = EXTENSION_MAP[extension]["mime_type"]
+    return set_validators(resp, etag, last_modified)
+
+
+@crop_cache_control
+def crop(request, id, ratio_slug, width, extension):
+    ratio = Ratio.get(ratio_slug)
+    if ratio is None:
         raise Http404
 
     width = int(width)
@@ -79,11 +239,38 @@ def crop(request, id, ratio_slug, width, extension):
 
     image_id = int(id.replace("/", ""))
 
+    if extension == "auto":
+        if not settings.BETTY_AUTO_FORMATS:
+            raise Http404
+        resp = crop_response(request, image_id, ratio, width, negotiate_extension(request))
+        patch_vary_headers(resp, ("Accept",))
+        return resp
+
+    if extension not in EXTENSION_MAP:
+        raise Http404
+    return crop_response(request, image_id, ratio, width, extension)
+
+
+def crop_response(request, image_id, ratio, width, extension):
+    ratio_slug = ratio.string
+
+    # Crops that have already been rendered get served right off the disk, without
+    # touching the database. Changing a selection deletes the affected crops.
+    resp = rendered_crop_response(
+        request,
+        Image(id=image_id).crop_path(ratio_slug, width, extension),
+        image_id, ratio_slug, width, extension
+    )
+    if resp is not None:
+        return resp
+
     try:
-        image = Image.objects.get(id=image_id)
+        with metrics.timed("db", ratio_slug, width, extension):
+            image = Image.objects.get(id=image_id)
     except Image.DoesNotExist:
         if settings.BETTY_PLACEHOLDER:
             img_blob = placeholder(ratio, width, extension)
+            metrics.record_request("placeholder", ratio_slug, width, extension, size=len(img_blob))
             resp = HttpResponse(img_blob)
             resp["Cache-Control"] = "no-cache, no-store, must-revalidate"
             resp["Pragma"] = "no-cache"
@@ -91,13 +278,46 @@ def crop(request, id, ratio_slug, width, extension):
             resp["Content-Type"] = EXTENSION_MAP[extension]["mime_type"]
             return resp
         else:
+            metrics.record_request("not_found", ratio_slug, width, extension)
             raise Http404
 
     try:
-        image_blob = image.crop(ratio, width, extension)
+        if is_saved_width(width):
+            # When a bunch of requests for the same crop come in at once, only the first
+            # one renders it, and everybody else waits around for the file.
+            crop_path = image.crop_path(ratio_slug, width, extension)
+            with render_lock(crop_path):
+                resp = rendered_crop_response(
+                    request, crop_path, image_id, ratio_slug, width, extension)
+                if resp is not None:
+                    return resp
+                image_blob = image.crop(ratio, width, extension)
+                try:
+                    etag, last_modified = file_validators(
+                        image_id, os.stat(crop_path), ratio_slug, width, extension)
+                except OSError:
+                    # The image changed while we were rendering, so the crop wasn't kept
+                    etag = crop_etag(
+                        image_id, image.get_version(ratio_slug), ratio_slug, width, extension)
+                    last_modified = None
+        else:
+            etag = crop_etag(image_id, image.get_version(ratio_slug), ratio_slug, width, extension)
+            last_modified = None
+            if is_not_modified(request, etag):
+                metrics.record_request("not_modified", ratio_slug, width, extension)
+                return set_validators(HttpResponseNotModified(), etag)
+            image_blob = image.crop(ratio, width, extension)
     except Exception:
+        metrics.record_request("error", ratio_slug, width, extension)
         return HttpResponseServerError("Cropping error")
 
+    metrics.record_request("miss", ratio_slug, width, extension, size=len(image_blob))
     resp = HttpResponse(image_blob)
     resp["Content-Type"] = EXTENSION_MAP[extension]["mime_type"]
-    return resp
+    return set_validators(resp, etag, last_modified)
+
+
+def metrics_view(request):
+    if not settings.BETTY_METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4")
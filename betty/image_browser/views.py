@@ -3,6 +3,7 @@ from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.shortcuts import render
 
 from betty.cropper.models import Image
+from betty.cropper.search import get_search_backend
 
 
 SIZE_MAP = {
@@ -25,7 +26,7 @@ def search(request):
     if request.GET.get("size", "all") in SIZE_MAP:
         queryset = queryset.filter(**SIZE_MAP[request.GET["size"]])
     if request.GET.get("q", "") != "":
-        queryset = queryset.filter(name__icontains=request.GET.get("q"))
+        queryset = get_search_backend().search(queryset, request.GET.get("q"))
 
     paginator = Paginator(queryset, 24)
     page = request.GET.get('page')
@@ -67,7 +67,7 @@ class BettyCropperStorage(Storage):
 
         return str(r.json()["id"])
 
-    def url(self, name, ratio="original", width=600, format="jpg"):
+    def url(self, name, ratio="original", width=600, format="jpg", version=None):
 
         id_string = ""
         for index, char in enumerate(str(name)):
@@ -75,9 +75,13 @@ class BettyCropperStorage(Storage):
                 id_string += "/"
             id_string += char
 
-        return "{base_url}/{id_string}/{ratio}/{width}.{format}".format(
+        url = "{base_url}/{id_string}/{ratio}/{width}.{format}".format(
             base_url=self.base_url,
             id_string=id_string,
             ratio=ratio,
             width=width,
             format=format)
+        if version:
+            # The version of a ratio is in the image's selections (see Image.get_version)
+            url += "?v={0}".format(version)
+        return url
@@ -39,7 +39,9 @@ install_requires = [
     "celery==3.1.11"
 ]
 
-server_requires = []
+server_requires = [
+    "numpy",
+]
 
 if 'test' in sys.argv:
     setup_requires.extend(dev_requires)
@@ -0,0 +1,81 @@
+"""Times search_image_quality's pixel error metric on the test images, against the
+original per-pixel loop
+
+Run from the repository root with:
+
+    > python tests/bench_image_quality.py
+"""
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+from PIL import Image as PILImage  # noqa
+
+from betty.cropper import tasks  # noqa
+
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
+MAX_AREA = 1000.0 * 1000.0
+
+
+def baseline_get_error(a, b):
+    """The original per-pixel implementation, timed for reference"""
+    assert a.size == b.size
+    difference = 0
+    for color_sets in izip(a.getdata(), b.getdata()):
+        distance = 0
+        for color_pair in zip(color_sets[0], color_sets[1]):
+            distance += ((color_pair[0] - color_pair[1]) ** 2)
+        difference += (distance ** 0.5)
+
+    pixel_error = difference / float(b.size[0] * b.size[1])
+    return pixel_error
+
+
+def load(filename):
+    im = PILImage.open(os.path.join(TEST_DATA_PATH, filename))
+    area = im.size[0] * im.size[1]
+    if area > MAX_AREA:
+        scale = MAX_AREA / area
+        im = im.resize((int(im.size[0] * scale), int(im.size[1] * scale)), PILImage.ANTIALIAS)
+    im = im.convert("RGB")
+
+    saved = io.BytesIO()
+    im.save(saved, format="JPEG", quality=80, optimize=True)
+    saved.seek(0)
+    return im, PILImage.open(saved).convert("RGB")
+
+
+def main():
+    _numpy = tasks.numpy
+    for filename in ("Lenna.png", "Sam_Hat1.jpg", "Header-Just_How.jpg", "tumblr.jpg"):
+        a, b = load(filename)
+        timings = {
+            "baseline": min(timeit.repeat(lambda: baseline_get_error(a, b), number=1, repeat=3))
+        }
+        for label, module in (("python", None), ("numpy", _numpy)):
+            if label == "numpy" and module is None:
+                continue
+            tasks.numpy = module
+            timings[label] = min(timeit.repeat(lambda: tasks.get_error(a, b), number=1, repeat=3))
+        tasks.numpy = _numpy
+
+        line = "{0:<22} {1[0]}x{1[1]}  baseline: {2:.3f}s".format(
+            filename, a.size, timings["baseline"])
+        for label in ("python", "numpy"):
+            if label in timings:
+                line += "  {0}: {1:.3f}s ({2:.0f}x)".format(
+                    label, timings[label], timings["baseline"] / timings[label])
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
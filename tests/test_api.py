@@ -1,14 +1,18 @@
 import os
 import json
+import re
 import shutil
 
 
+from django.core import management
 from django.test import TestCase, Client
+from django.utils.six import StringIO
 
 from django.contrib.auth.models import User
 
 from betty.conf.app import settings
-from betty.cropper.models import Image
+from betty.cropper.api.views import RENDER_MAX_TARGETS
+from betty.cropper.models import Image, Ratio
 
 TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
 
@@ -69,6 +73,52 @@ class APITestCase(TestCase):
         self.assertEqual(image.name, "LENNA DOT PNG")
         self.assertEqual(image.credit, "Playboy")
 
+    def test_async_image_upload(self):
+        assert self.client.login(username="admin", password=self.password)
+
+        huge_path = os.path.join(TEST_DATA_PATH, "huge.jpg")
+        settings.BETTY_ASYNC_INGEST = True
+        try:
+            with open(huge_path, "rb") as huge:
+                res = self.client.post('/images/api/new', {"image": huge})
+        finally:
+            settings.BETTY_ASYNC_INGEST = False
+        self.assertEqual(res.status_code, 200)
+        response_json = json.loads(res.content.decode("utf-8"))
+
+        # The source is 8720x8494, but selections are made against the optimized image
+        self.assertEqual(response_json["width"], settings.BETTY_MAX_WIDTH)
+        self.assertEqual(response_json["height"], 3117)
+        selection = response_json["selections"]["1x1"]
+        self.assertTrue(selection["x1"] <= settings.BETTY_MAX_WIDTH)
+
+        # A selection made from that response is kept once the image is optimized
+        selection = {"x0": 0, "y0": 0, "x1": 3000, "y1": 3000}
+        res = self.client.post(
+            "/images/api/{0}/1x1".format(response_json["id"]),
+            data=json.dumps(selection),
+            content_type="application/json",
+        )
+        self.assertEqual(res.status_code, 200)
+        image = Image.objects.get(id=response_json["id"])
+        self.assertEqual(image.get_selection(Ratio.get("1x1")), selection)
+
+    def test_in_memory_image_upload(self):
+        assert self.client.login(username="admin", password=self.password)
+
+        lenna_path = os.path.join(TEST_DATA_PATH, 'Lenna.png')
+        memory_handler = "django.core.files.uploadhandler.MemoryFileUploadHandler"
+        with self.settings(FILE_UPLOAD_HANDLERS=[memory_handler]):
+            with open(lenna_path, "rb") as lenna:
+                res = self.client.post('/images/api/new', {"image": lenna})
+        self.assertEqual(res.status_code, 200)
+        response_json = json.loads(res.content.decode("utf-8"))
+        self.assertEqual(response_json.get('width'), 512)
+
+        image = Image.objects.get(id=response_json['id'])
+        self.assertEqual(os.path.getsize(image.source.path), os.path.getsize(lenna_path))
+        self.assertTrue(os.path.exists(image.optimized.path))
+
     def test_update_selection(self):
         assert self.client.login(username="admin", password=self.password)
 
@@ -159,6 +209,86 @@ class APITestCase(TestCase):
         )
         self.assertEqual(res.status_code, 200)
 
+    def test_warm_crops(self):
+        assert self.client.login(username="admin", password=self.password)
+
+        _cached_widths = settings.BETTY_WIDTHS
+        settings.BETTY_WIDTHS = [80, 240]
+        settings.BETTY_WARM_CROPS = True
+        try:
+            lenna_path = os.path.join(TEST_DATA_PATH, 'Lenna.png')
+            image = Image.objects.create_from_path(lenna_path)
+            for ratio in settings.BETTY_RATIOS:
+                for width in (80, 240):
+                    self.assertTrue(os.path.exists(image.crop_path(ratio, width, "jpg")))
+
+            res = self.client.post(
+                "/images/api/{0}/1x1".format(image.id),
+                data=json.dumps({"x0": 1, "y0": 1, "x1": 510, "y1": 510}),
+                content_type="application/json",
+            )
+            self.assertEqual(res.status_code, 200)
+            # The selection changed, so the 1x1 crops should have been re-rendered
+            self.assertTrue(os.path.exists(image.crop_path("1x1", 240, "jpg")))
+        finally:
+            settings.BETTY_WIDTHS = _cached_widths
+            settings.BETTY_WARM_CROPS = False
+
+    def test_render(self):
+        assert self.client.login(username="admin", password=self.password)
+
+        lenna_path = os.path.join(TEST_DATA_PATH, 'Lenna.png')
+        image = Image.objects.create_from_path(lenna_path)
+
+        targets = [
+            {"ratio": "1x1", "width": 80},
+            {"ratio": "1x1", "width": 240},
+            {"ratio": "1x1", "width": 240, "format": "png"},
+            {"ratio": "16x9", "width": 640},
+            {"ratio": "16x9", "width": 640, "format": "jpg"},
+        ]
+        res = self.client.post(
+            "/images/api/{0}/render".format(image.id),
+            data=json.dumps({"targets": targets}),
+            content_type="application/json",
+        )
+        self.assertEqual(res.status_code, 200)
+        rendered = json.loads(res.content.decode("utf-8"))["rendered"]
+        self.assertEqual(len(rendered), 4)
+
+        self.assertTrue(os.path.exists(image.crop_path("1x1", 80, "jpg")))
+        self.assertTrue(os.path.exists(image.crop_path("1x1", 240, "jpg")))
+        self.assertTrue(os.path.exists(image.crop_path("1x1", 240, "png")))
+        self.assertTrue(os.path.exists(image.crop_path("16x9", 640, "jpg")))
+
+        res = self.client.post(
+            "/images/api/{0}/render".format(image.id),
+            data=json.dumps({"targets": [{"ratio": "13x4", "width": 80}]}),
+            content_type="application/json",
+        )
+        self.assertEqual(res.status_code, 400)
+
+        # 81 isn't in BETTY_WIDTHS, so it would never be saved
+        res = self.client.post(
+            "/images/api/{0}/render".format(image.id),
+            data=json.dumps({"targets": [{"ratio": "1x1", "width": 81}]}),
+            content_type="application/json",
+        )
+        self.assertEqual(res.status_code, 400)
+
+        too_many = [
+            {"ratio": ratio, "width": width, "format": extension}
+            for ratio in settings.BETTY_RATIOS for width in settings.BETTY_WIDTHS
+            for extension in ("jpg", "png")
+        ]
+        self.assertTrue(len(too_many) > RENDER_MAX_TARGETS)
+        res = self.client.post(
+            "/images/api/{0}/render".format(image.id),
+            data=json.dumps({"targets": too_many}),
+            content_type="application/json",
+        )
+        self.assertEqual(res.status_code, 400)
+
     def test_image_detail(self):
         assert self.client.login(username="admin", password=self.password)
         image = Image.objects.create(name="Testing", width=512, height=512)
@@ -176,6 +306,54 @@ class APITestCase(TestCase):
         image = Image.objects.get(id=image.id)
         self.assertEqual(image.name, "Updated")
 
+    def test_patch_selections_clears_crops(self):
+        assert self.client.login(username="admin", password=self.password)
+
+        lenna_path = os.path.join(TEST_DATA_PATH, 'Lenna.png')
+        image = Image.objects.create_from_path(lenna_path)
+
+        self.client.get("/images/{}/1x1/240.jpg".format(image.id))
+        self.client.get("/images/{}/16x9/240.jpg".format(image.id))
+        self.assertTrue(os.path.exists(os.path.join(image.path(), "1x1", "240.jpg")))
+        self.assertTrue(os.path.exists(os.path.join(image.path(), "16x9", "240.jpg")))
+
+        res = self.client.patch(
+            "/images/api/{0}".format(image.id),
+            data=json.dumps({"selections": {"1x1": {"x0": 1, "y0": 1, "x1": 510, "y1": 510}}}),
+            content_type="application/json",
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(os.path.exists(os.path.join(image.path(), "1x1", "240.jpg")))
+        self.assertTrue(os.path.exists(os.path.join(image.path(), "16x9", "240.jpg")))
+
+    def test_cache_flusher(self):
+        assert self.client.login(username="admin", password=self.password)
+
+        lenna_path = os.path.join(TEST_DATA_PATH, 'Lenna.png')
+        image = Image.objects.create_from_path(lenna_path)
+        for width in (240, 320, 640):
+            self.client.get("/images/{}/1x1/{}.jpg".format(image.id, width))
+
+        flushed = []
+        settings.BETTY_CACHE_FLUSHER = flushed.append
+        settings.BETTY_CACHE_FLUSHER_BATCH_SIZE = 2
+        try:
+            res = self.client.patch(
+                "/images/api/{0}".format(image.id),
+                data=json.dumps({"selections": {"1x1": {"x0": 1, "y0": 1, "x1": 510, "y1": 510}}}),
+                content_type="application/json",
+            )
+        finally:
+            settings.BETTY_CACHE_FLUSHER = None
+            settings.BETTY_CACHE_FLUSHER_BATCH_SIZE = None
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual([len(batch) for batch in flushed], [2, 1])
+        self.assertEqual(
+            sorted(url for batch in flushed for url in batch),
+            sorted(image.get_absolute_url(ratio="1x1", width=width) for width in (240, 320, 640))
+        )
+
     def test_image_search(self):
         assert self.client.login(username="admin", password=self.password)
         image = Image.objects.create(name="BLERGH", width=512, height=512)
@@ -186,6 +364,56 @@ class APITestCase(TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results["results"][0]["id"], image.id)
 
+    def test_image_search_pagination(self):
+        assert self.client.login(username="admin", password=self.password)
+        images = [Image.objects.create(name="BLERGH", width=512, height=512) for _ in range(3)]
+
+        res = self.client.get('/images/api/search?q=blergh&limit=2&fields=id,name')
+        self.assertEqual(res.status_code, 200)
+        results = json.loads(res.content.decode("utf-8"))["results"]
+        self.assertEqual(results, [
+            {"id": images[2].id, "name": "BLERGH"},
+            {"id": images[1].id, "name": "BLERGH"},
+        ])
+        self.assertIn('rel="next"', res["Link"])
+        next_url = re.match(r'<(.+)>; rel="next"', res["Link"]).group(1)
+
+        res = self.client.get(next_url.replace("fields=id%2Cname", "fields="))
+        self.assertEqual(res.status_code, 200)
+        results = json.loads(res.content.decode("utf-8"))["results"]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["id"], images[0].id)
+        self.assertIn("selections", results[0])
+        self.assertFalse(res.has_header("Link"))
+
+        for params in ("cursor=abc", "limit=0", "limit=-1", "q=blergh&limit=0", "cursor=-1",
+                       "q=blergh&cursor=-1"):
+            res = self.client.get('/images/api/search?{0}'.format(params))
+            self.assertEqual(res.status_code, 400)
+
+        # Without a query, pages are keyed on the image id
+        res = self.client.get('/images/api/search?limit=2&fields=id')
+        self.assertIn("cursor={0}".format(images[1].id), res["Link"])
+
+    def test_indexed_search(self):
+        assert self.client.login(username="admin", password=self.password)
+        management.call_command("rebuild_search_index", stdout=StringIO())
+
+        lenna = Image.objects.create(name="LENNA DOT PNG", credit="Playboy", width=512, height=512)
+        Image.objects.create(name="Sam Hat", credit="Someone", width=512, height=512)
+
+        for query in ("lenna", "LEN", "playboy", "lenna playboy"):
+            res = self.client.get('/images/api/search?fields=id&q={0}'.format(query))
+            self.assertEqual(res.status_code, 200)
+            results = json.loads(res.content.decode("utf-8"))["results"]
+            self.assertEqual(results, [{"id": lenna.id}])
+
+        lenna.name = "Renamed"
+        lenna.credit = None
+        lenna.save()
+        res = self.client.get('/images/api/search?fields=id&q=lenna')
+        self.assertEqual(json.loads(res.content.decode("utf-8"))["results"], [])
+
     def test_bad_image_data(self):
         assert self.client.login(username="admin", password=self.password)
         lenna_path = os.path.join(TEST_DATA_PATH, 'Lenna.png')
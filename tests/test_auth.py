@@ -22,3 +22,29 @@ class AuthTestCase(TestCase):
             "/images/api/search?q=testing",
             HTTP_X_BETTY_API_KEY=token.public_token)
         self.assertEquals(response.status_code, 200)
+
+    def test_token_cache(self):
+        token = ApiToken.objects.create_cropping_user()
+
+        user = ApiToken.objects.get_user(token.public_token)
+        self.assertTrue(user.has_perm("server.image_crop"))
+        self.assertFalse(user.has_perm("server.image_change"))
+
+        # Cached lookups shouldn't hit the database
+        with self.assertNumQueries(0):
+            user = ApiToken.objects.get_user(token.public_token)
+        self.assertTrue(user.has_perm("server.image_crop"))
+
+        # Saving the token invalidates the cache
+        token.image_change_permission = True
+        token.save()
+        user = ApiToken.objects.get_user(token.public_token)
+        self.assertTrue(user.has_perm("server.image_change"))
+
+        # ...and so does deleting it
+        token.delete()
+        self.assertEqual(ApiToken.objects.get_user(token.public_token), None)
+        response = Client().get(
+            "/images/api/search?q=testing",
+            HTTP_X_BETTY_API_KEY=token.public_token)
+        self.assertEquals(response.status_code, 403)
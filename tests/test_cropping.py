@@ -1,11 +1,21 @@
+import io
 import os
 import shutil
+import threading
+import time
 
 from django.test import TestCase, Client
 from django.core.files import File
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage
+from PIL import ImageChops, ImageStat
 
 from betty.conf.app import settings
+from betty.cropper import metrics
 from betty.cropper.models import Image, Ratio
+from betty.cropper.utils import locks, placeholder
+from betty.cropper.utils.locks import render_lock
+from betty.cropper.views import EXTENSION_MAP
 
 TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
 
@@ -90,6 +100,37 @@ class ImageSavingTestCase(TestCase):
             {'x0': 0, 'y0': 0, 'x1': 512, 'y1': 512}
         )
 
+    def test_selection_memo(self):
+        image = Image.objects.create(name="Lenna.gif", width=512, height=512)
+
+        selection = image.get_selection(Ratio('1x1'))
+        selection["x0"] = 100  # Callers get their own copy
+        self.assertEqual(image.get_selection(Ratio('1x1'))["x0"], 0)
+
+        image.selections = {'1x1': {'x0': 10, 'y0': 10, 'x1': 500, 'y1': 500}}
+        image.save()
+        self.assertEqual(
+            image.get_selection(Ratio('1x1')),
+            {'x0': 10, 'y0': 10, 'x1': 500, 'y1': 500}
+        )
+
+        data = image.to_native()
+        self.assertEqual(data["selections"]["1x1"]["source"], "user")
+        self.assertEqual(data["selections"]["16x9"]["source"], "auto")
+        # Serializing shouldn't leak into the stored selections
+        self.assertNotIn("source", image.selections["1x1"])
+
+    def test_ratio_registry(self):
+        ratio = Ratio.get("16x9")
+        self.assertIs(Ratio.get("16x9"), ratio)
+        self.assertEqual((ratio.width, ratio.height), (16, 9))
+        self.assertAlmostEqual(ratio.aspect, 16 / 9.0)
+        self.assertEqual(Ratio.get("original").string, "original")
+        self.assertEqual(Ratio.get("13x4"), None)
+
+        with self.assertRaises(AttributeError):
+            ratio.width = 4
+
     def test_bad_image_id(self):
         res = self.client.get('/images/abc/13x4/256.jpg')
         self.assertEqual(res.status_code, 404)
@@ -133,6 +174,24 @@ class ImageSavingTestCase(TestCase):
         res = self.client.get('/images/666/1x1/256.jpg')
         self.assertEqual(res.status_code, 404)
 
+    def test_placeholder_cache(self):
+        first = placeholder.placeholder(Ratio.get("1x1"), 256, "jpg")
+        self.assertIs(placeholder.placeholder(Ratio.get("1x1"), 256, "jpg"), first)
+        self.assertEqual(len(placeholder._fonts), 1)
+
+        # "original" placeholders pick the same ratio and color every time, too
+        original = placeholder.placeholder(Ratio.get("original"), 256, "png")
+        self.assertIs(placeholder.placeholder(Ratio.get("original"), 256, "png"), original)
+
+        _cached_size = settings.BETTY_PLACEHOLDER_CACHE_SIZE
+        settings.BETTY_PLACEHOLDER_CACHE_SIZE = 2
+        try:
+            for width in (100, 200, 300):
+                placeholder.placeholder(Ratio.get("1x1"), width, "jpg")
+            self.assertEqual(len(placeholder._placeholders), 2)
+        finally:
+            settings.BETTY_PLACEHOLDER_CACHE_SIZE = _cached_size
+
     def test_missing_file(self):
         image = Image.objects.create(name="Lenna.gif", width=512, height=512)
 
@@ -173,6 +232,303 @@ class ImageSavingTestCase(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertFalse(os.path.exists(os.path.join(image.path(), 'original', '666.jpg')))
 
+    def test_rendered_crop(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        res = self.client.get('/images/{}/1x1/240.jpg'.format(image.id))
+        self.assertEqual(res.status_code, 200)
+        crop_path = os.path.join(image.path(), '1x1', '240.jpg')
+        self.assertTrue(os.path.exists(crop_path))
+
+        # Once the crop exists on disk, it gets served as-is.
+        with open(crop_path, "wb") as f:
+            f.write(b"rendered")
+
+        res = self.client.get('/images/{}/1x1/240.jpg'.format(image.id))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'image/jpeg')
+        self.assertEqual(b"".join(res.streaming_content), b"rendered")
+
+        # Clearing the crops means it will get re-rendered.
+        image.clear_crops(ratios=["1x1"])
+        self.assertFalse(os.path.exists(crop_path))
+        res = self.client.get('/images/{}/1x1/240.jpg'.format(image.id))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.content, b"rendered")
+
+    def test_jpeg_encoder_profiles(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        small = PILImage.open(io.BytesIO(image.crop(Ratio.get("1x1"), 240, "jpg")))
+        self.assertNotIn("progressive", small.info)
+
+        large = PILImage.open(io.BytesIO(image.crop(Ratio.get("1x1"), 640, "jpg")))
+        self.assertIn("progressive", large.info)
+
+        _cached_profiles = settings.BETTY_JPEG_ENCODER_PROFILES
+        settings.BETTY_JPEG_ENCODER_PROFILES = []
+        try:
+            large = PILImage.open(io.BytesIO(image.crop(Ratio.get("1x1"), 640, "jpg")))
+            self.assertNotIn("progressive", large.info)
+        finally:
+            settings.BETTY_JPEG_ENCODER_PROFILES = _cached_profiles
+
+    def test_auto_format(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        res = self.client.get('/images/{}/1x1/240.auto'.format(image.id))
+        self.assertEqual(res.status_code, 404)
+
+        webp_type = "image/webp" if "webp" in EXTENSION_MAP else "image/jpeg"
+        settings.BETTY_AUTO_FORMATS = ["avif", "webp"]
+        try:
+            res = self.client.get(
+                '/images/{}/1x1/240.auto'.format(image.id),
+                HTTP_ACCEPT="image/webp,image/avif;q=0,*/*;q=0.8"
+            )
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res['Content-Type'], webp_type)
+            self.assertIn("Accept", res["Vary"])
+
+            res = self.client.get('/images/{}/1x1/240.auto'.format(image.id))
+            self.assertEqual(res['Content-Type'], "image/jpeg")
+        finally:
+            settings.BETTY_AUTO_FORMATS = []
+
+    def test_auto_format_cleared(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        image.crop(Ratio.get("1x1"), 240, "jpg")
+        image.crop(Ratio.get("1x1"), 240, "png")
+        self.assertEqual(len(image.clear_crops(ratios=["1x1"])), 2)
+
+        image.crop(Ratio.get("1x1"), 240, "jpg")
+        image.crop(Ratio.get("1x1"), 240, "png")
+        settings.BETTY_AUTO_FORMATS = ["webp"]
+        try:
+            urls = image.clear_crops(ratios=["1x1"])
+        finally:
+            settings.BETTY_AUTO_FORMATS = []
+        self.assertEqual(len(urls), 3)
+        self.assertIn(
+            image.get_absolute_url(ratio="1x1", width=240, format="auto", version=False), urls)
+
+    def test_modern_format_alpha(self):
+        if "webp" not in EXTENSION_MAP:
+            return
+
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+        opaque = PILImage.open(io.BytesIO(image.crop(Ratio.get("1x1"), 240, "webp")))
+        self.assertEqual(opaque.mode, "RGB")
+
+        transparent = PILImage.new("RGBA", (512, 512), (255, 0, 0, 128))
+        saved = io.BytesIO()
+        transparent.save(saved, format="png")
+        image = Image.objects.create(name="transparent.png", width=512, height=512)
+        image.source.save("transparent.png", ContentFile(saved.getvalue()))
+        crop = PILImage.open(io.BytesIO(image.crop(Ratio.get("1x1"), 240, "webp")))
+        self.assertEqual(crop.mode, "RGBA")
+
+    def test_metrics(self):
+        res = self.client.get('/images/metrics')
+        self.assertEqual(res.status_code, 404)
+
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        settings.BETTY_METRICS_ENABLED = True
+        try:
+            for metric in metrics.registry:
+                metric.clear()
+            self.client.get('/images/{}/1x1/240.jpg'.format(image.id))
+            self.client.get('/images/{}/1x1/240.jpg'.format(image.id))
+            res = self.client.get('/images/metrics')
+        finally:
+            settings.BETTY_METRICS_ENABLED = False
+
+        self.assertEqual(res.status_code, 200)
+        text = res.content.decode("utf-8")
+        labels = 'ratio="1x1",width="320",extension="jpg"'
+        self.assertIn('betty_crop_requests_total{{result="miss",{0}}} 1'.format(labels), text)
+        self.assertIn('betty_crop_requests_total{{result="hit",{0}}} 1'.format(labels), text)
+        self.assertIn('betty_crop_stage_seconds_count{{stage="db",{0}}} 1'.format(labels), text)
+        self.assertIn('betty_crop_stage_seconds_count{{stage="encode",{0}}} 1'.format(labels), text)
+
+    def test_conditional_requests(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        # A saved width gets its validators from the rendered file
+        url = '/images/{}/1x1/240.jpg'.format(image.id)
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        etag = res["ETag"]
+        self.assertEqual(self.client.get(url)["ETag"], etag)
+
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get(url, HTTP_IF_MODIFIED_SINCE=res["Last-Modified"])
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get(url, HTTP_IF_NONE_MATCH='"something-else"')
+        self.assertEqual(res.status_code, 200)
+
+        # Other widths use the image's version
+        url = '/images/{}/1x1/250.jpg'.format(image.id)
+        etag = self.client.get(url)["ETag"]
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+
+        image.selections = {"1x1": {"x0": 1, "y0": 1, "x1": 510, "y1": 510}}
+        image.save()
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+
+    def test_versioned_urls(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        version = image.to_native()["selections"]["1x1"]["version"]
+        self.assertEqual(image.get_version("1x1"), version)
+        self.assertFalse("?" in image.get_absolute_url(ratio="1x1", width=240))
+
+        settings.BETTY_VERSIONED_URLS = True
+        try:
+            url = image.get_absolute_url(ratio="1x1", width=240)
+        finally:
+            settings.BETTY_VERSIONED_URLS = False
+        self.assertTrue(url.endswith("?v={0}".format(version)))
+
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("immutable", res["Cache-Control"])
+        self.assertIn("max-age={0}".format(settings.BETTY_VERSIONED_CACHE_MAX_AGE),
+                      res["Cache-Control"])
+
+        res = self.client.get(image.get_absolute_url(ratio="1x1", width=240))
+        self.assertEqual(res["Cache-Control"], "max-age=300")
+
+        # Tokens that aren't current don't get cached for long
+        res = self.client.get(image.get_absolute_url(ratio="1x1", width=240, version="nope"))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res["Cache-Control"], "max-age=300")
+
+        # The original doesn't have a selection, but gets a version all the same
+        res = self.client.get(image.get_absolute_url(
+            ratio="original", width=240, version=image.get_version("original")))
+        self.assertIn("immutable", res["Cache-Control"])
+
+        image.selections = {"1x1": {"x0": 1, "y0": 1, "x1": 510, "y1": 510}}
+        image.save()
+        self.assertNotEqual(image.get_version("1x1"), version)
+        self.assertEqual(Image.objects.get_versions(image.id)["1x1"], image.get_version("1x1"))
+        res = self.client.get(url)
+        self.assertEqual(res["Cache-Control"], "max-age=300")
+
+    def test_warm_crops_decodes_once(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        opened = []
+        open_source = image.open_source
+
+        def counting_open_source():
+            opened.append(True)
+            return open_source()
+        image.open_source = counting_open_source
+
+        _cached_popular = settings.BETTY_POPULAR_WIDTHS
+        settings.BETTY_POPULAR_WIDTHS = [320]
+        try:
+            image.warm_crops(ratios=["1x1", "16x9"], widths=[240, 320, 640])
+        finally:
+            settings.BETTY_POPULAR_WIDTHS = _cached_popular
+
+        self.assertEqual(len(opened), 1)
+        for ratio_slug in ("1x1", "16x9"):
+            for width in (240, 320, 640):
+                self.assertTrue(os.path.exists(image.crop_path(ratio_slug, width, "jpg")))
+
+    def test_warm_crops_after_image_js(self):
+        self.client.get("/images/image.js")
+
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        image.warm_crops(ratios=["1x1"])
+        self.assertTrue(os.path.exists(image.crop_path("1x1", 240, "jpg")))
+        self.assertFalse(os.path.exists(image.crop_path("1x1", 0, "jpg")))
+
+    def test_stale_crop(self):
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        # This one still has the old selections, like a render that was already running
+        stale = Image.objects.get(id=image.id)
+        stale.get_selection(Ratio.get("1x1"))
+
+        image.selections = {"1x1": {"x0": 1, "y0": 1, "x1": 510, "y1": 510}}
+        image.save()
+        image.clear_crops(ratios=["1x1"])
+
+        stale.crop(Ratio.get("1x1"), 240, "jpg")
+        stale.render([("1x1", 320, "jpg"), ("16x9", 320, "jpg")])
+        self.assertFalse(os.path.exists(image.crop_path("1x1", 240, "jpg")))
+        self.assertFalse(os.path.exists(image.crop_path("1x1", 320, "jpg")))
+        # The 16x9 selection didn't change, so that one is fine
+        self.assertTrue(os.path.exists(image.crop_path("16x9", 320, "jpg")))
+
+        image.crop(Ratio.get("1x1"), 240, "jpg")
+        self.assertTrue(os.path.exists(image.crop_path("1x1", 240, "jpg")))
+
+    def test_fresh_instance_crop(self):
+        # An instance that was never loaded from the database still matches the saved record
+        image = Image.objects.create(name="Lenna.png", width=512, height=512)
+        lenna = File(open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb"))
+        image.source.save("Lenna.png", lenna)
+
+        image.crop(Ratio.get("1x1"), 240, "jpg")
+        image.render([("16x9", 320, "jpg")])
+        self.assertTrue(os.path.exists(image.crop_path("1x1", 240, "jpg")))
+        self.assertTrue(os.path.exists(image.crop_path("16x9", 320, "jpg")))
+
+    def test_render_lock(self):
+        path = os.path.join(settings.BETTY_IMAGE_ROOT, "1", "1x1", "240.jpg")
+        state = {"active": 0, "max_active": 0}
+
+        def render():
+            with render_lock(path):
+                state["active"] += 1
+                state["max_active"] = max(state["active"], state["max_active"])
+                time.sleep(0.01)
+                state["active"] -= 1
+
+        threads = [threading.Thread(target=render) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(state["max_active"], 1)
+        self.assertEqual(locks._thread_locks, {})
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
     def test_non_rgb(self):
         image = Image.objects.create(
             name="animated.gif",
@@ -193,6 +549,22 @@ class ImageSavingTestCase(TestCase):
         self.assertEqual(res['Content-Type'], 'image/jpeg')
         self.assertTrue(os.path.exists(os.path.join(image.path(), 'original/1200.jpg')))
 
+    def test_draft_mode(self):
+        image = Image.objects.create(name="Sam_Hat1.jpg", width=3264, height=2448)
+        sam = File(open(os.path.join(TEST_DATA_PATH, "Sam_Hat1.jpg"), "rb"))
+        image.source.save("Sam_Hat1.jpg", sam)
+
+        settings.BETTY_JPEG_DRAFT_MODE = False
+        full = PILImage.open(io.BytesIO(image.crop(Ratio("16x9"), 300, "png")))
+        settings.BETTY_JPEG_DRAFT_MODE = True
+        drafted = PILImage.open(io.BytesIO(image.crop(Ratio("16x9"), 300, "png")))
+
+        self.assertEqual(full.size, drafted.size)
+        # The DCT-scaled version should look just about the same
+        stat = ImageStat.Stat(ImageChops.difference(full, drafted))
+        for channel_mean in stat.mean:
+            self.assertTrue(channel_mean < 2.0)
+
     def test_image_js(self):
         res = self.client.get("/images/image.js")
         self.assertEqual(res.status_code, 200)
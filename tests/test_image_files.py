@@ -1,3 +1,4 @@
+import io
 import os
 import shutil
 import stat
@@ -6,6 +7,7 @@ from django.test import TestCase
 from PIL import Image as PILImage
 from PIL import JpegImagePlugin
 
+from betty.cropper import tasks
 from betty.cropper.models import Image
 from betty.conf.app import settings
 
@@ -180,6 +182,74 @@ class ImageFileTestCase(TestCase):
         # Lenna should be a 95 quality, but we'll leave a fudge factor
         self.assertTrue(abs(image.jpeg_quality - 95) < 2)
 
+    def test_pixel_error(self):
+        a = PILImage.open(os.path.join(TEST_DATA_PATH, "Lenna.png")).convert("RGB")
+        saved = io.BytesIO()
+        a.save(saved, format="JPEG", quality=60)
+        saved.seek(0)
+        b = PILImage.open(saved)
+
+        self.assertEqual(tasks.get_error(a, a), 0)
+
+        error = tasks.get_error(a, b)
+        self.assertTrue(error > 0)
+
+        gray_a, gray_b = a.convert("L"), b.convert("L")
+        gray_error = tasks.get_error(gray_a, gray_b)
+        self.assertTrue(gray_error > 0)
+
+        _numpy = tasks.numpy
+        tasks.numpy = None
+        try:
+            self.assertAlmostEqual(tasks.get_error(a, b), error, places=6)
+            self.assertAlmostEqual(tasks.get_error(gray_a, gray_b), gray_error, places=6)
+        finally:
+            tasks.numpy = _numpy
+
+    def test_parallel_quality_search(self):
+        probed = []
+
+        def is_acceptable(quality):
+            probed.append(quality)
+            return quality >= 83 and quality != 90
+
+        sequential = tasks.search_quality(is_acceptable, (60, 95), threads=1)
+        sequential_probes = len(probed)
+        self.assertEqual(sequential, 83)
+
+        for threads in (2, 3, 7):
+            self.assertEqual(
+                tasks.search_quality(is_acceptable, (60, 95), threads=threads), sequential)
+        self.assertTrue(len(probed) > sequential_probes)
+
+        # Every thread gets something to probe, even when they don't fill a whole level
+        self.assertEqual(tasks.get_candidates((60, 96), 1), [78])
+        self.assertEqual(tasks.get_candidates((60, 96), 2), [78, 87])
+        self.assertEqual(tasks.get_candidates((60, 96), 2, known={87: True}), [78, 69])
+        self.assertEqual(len(tasks.get_candidates((60, 96), 5)), 5)
+
+    def test_parallel_image_quality_search(self):
+        path = os.path.join(TEST_DATA_PATH, "Lenna.png")
+        image = Image.objects.create_from_path(path)
+
+        _cached_range = settings.BETTY_JPEG_QUALITY_RANGE
+        _cached_error = settings.BETTY_JPEG_MAX_ERROR
+        settings.BETTY_JPEG_QUALITY_RANGE = (60, 95)
+        try:
+            # A looser error limit puts the answer in the middle of the range
+            for max_error in (_cached_error, 6.0):
+                settings.BETTY_JPEG_MAX_ERROR = max_error
+                qualities = []
+                for threads in (1, 7):
+                    settings.BETTY_JPEG_QUALITY_SEARCH_THREADS = threads
+                    tasks.search_image_quality.apply(args=(image.id,))
+                    qualities.append(Image.objects.get(id=image.id).jpeg_quality)
+                self.assertEqual(qualities[0], qualities[1])
+        finally:
+            settings.BETTY_JPEG_QUALITY_RANGE = _cached_range
+            settings.BETTY_JPEG_MAX_ERROR = _cached_error
+            settings.BETTY_JPEG_QUALITY_SEARCH_THREADS = 1
+
     def test_gif_upload(self):
 
         path = os.path.join(TEST_DATA_PATH, "animated.gif")
@@ -210,5 +280,42 @@ class ImageFileTestCase(TestCase):
             )
         )
 
+    def test_async_ingest(self):
+        settings.BETTY_ASYNC_INGEST = True
+        try:
+            path = os.path.join(TEST_DATA_PATH, "animated.gif")
+            image = Image.objects.create_from_path(path)
+        finally:
+            settings.BETTY_ASYNC_INGEST = False
+
+        self.assertEqual(image.width, 256)
+        self.assertEqual(image.height, 256)
+        self.assertTrue(image.animated)
+
+        # Re-load the image, now that the task is done
+        image = Image.objects.get(id=image.id)
+        self.assertTrue(os.path.exists(image.optimized.path))
+        self.assertTrue(os.path.exists(os.path.join(image.path(), "animated/original.jpg")))
+
+    def test_dedupe(self):
+        path = os.path.join(TEST_DATA_PATH, "Lenna.png")
+        image = Image.objects.create_from_path(path)
+        self.assertEqual(len(image.content_hash), 40)
+
+        settings.BETTY_DEDUPE = "record"
+        try:
+            self.assertEqual(Image.objects.create_from_path(path).id, image.id)
+
+            settings.BETTY_DEDUPE = "files"
+            duplicate = Image.objects.create_from_path(path, name="Lenna again")
+        finally:
+            settings.BETTY_DEDUPE = None
+
+        self.assertNotEqual(duplicate.id, image.id)
+        self.assertEqual(duplicate.name, "Lenna again")
+        self.assertEqual(duplicate.content_hash, image.content_hash)
+        self.assertTrue(os.path.samefile(duplicate.source.path, image.source.path))
+        self.assertTrue(os.path.samefile(duplicate.optimized.path, image.optimized.path))
+
     def tearDown(self):
         shutil.rmtree(settings.BETTY_IMAGE_ROOT, ignore_errors=True)
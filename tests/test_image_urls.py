@@ -20,6 +20,8 @@ class AuthTestCase(TestCase):
         self.assertEquals(image.get_absolute_url(width=900), "/images/1234/56/original/900.jpg")
         self.assertEquals(image.get_absolute_url(ratio="16x9"), "/images/1234/56/16x9/600.jpg")
         self.assertEquals(image.get_absolute_url(format="png", width=900, ratio="16x9"), "/images/1234/56/16x9/900.png")
+        self.assertEquals(
+            image.get_absolute_url(version="abc123"), "/images/1234/56/original/600.jpg?v=abc123")
 
         image = Image.objects.create(id=123)
         self.assertEquals(image.get_absolute_url(), "/images/123/original/600.jpg")
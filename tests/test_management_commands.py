@@ -1,8 +1,16 @@
+import os
+import shutil
+
 import django
 from django.core import management
 from django.core.management.base import CommandError
 from django.test import TestCase
+from django.utils.six import StringIO
 from betty.authtoken.models import ApiToken
+from betty.conf.app import settings
+from betty.cropper.models import Image, optimized_upload_to
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
 
 
 class CreateTokenTestCase(TestCase):
@@ -24,3 +32,89 @@ class CreateTokenTestCase(TestCase):
 
             with self.assertRaises(CommandError):
                 management.call_command("create_token", "noop", "noop", "noop")
+
+
+class OptimizeImagesTestCase(TestCase):
+
+    def test_optimize_images(self):
+        images = [
+            Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+            for _ in range(3)
+        ]
+        for image in images:
+            image.optimized.name = None
+            image.save()
+
+        stdout = StringIO()
+        management.call_command("optimize_images", batch_size=2, stdout=stdout)
+        for image in images:
+            image = Image.objects.get(id=image.id)
+            self.assertTrue(os.path.exists(image.optimized.path))
+        self.assertIn("Processed 3 images", stdout.getvalue())
+
+    def test_resume_from_id(self):
+        first = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+        second = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+        for image in (first, second):
+            image.optimized.name = None
+            image.save()
+
+        management.call_command("optimize_images", resume_from_id=second.id, stdout=StringIO())
+        self.assertFalse(Image.objects.get(id=first.id).optimized)
+        self.assertTrue(Image.objects.get(id=second.id).optimized)
+
+    def test_workers(self):
+        images = [
+            Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+            for _ in range(3)
+        ]
+        for image in images:
+            os.remove(image.optimized.path)
+            image.optimized.name = None
+            image.save()
+
+        # The workers save to their own database connections, so check the files they wrote.
+        stdout = StringIO()
+        stderr = StringIO()
+        management.call_command(
+            "optimize_images", workers=2, batch_size=2, stdout=stdout, stderr=stderr)
+        for image in images:
+            self.assertTrue(os.path.exists(optimized_upload_to(image, "Lenna.png")))
+        self.assertIn("Processed 3 images", stdout.getvalue())
+        self.assertEqual(stderr.getvalue(), "")
+
+    def test_quality_search(self):
+        _cached_range = settings.BETTY_JPEG_QUALITY_RANGE
+        settings.BETTY_JPEG_QUALITY_RANGE = None
+        try:
+            lenna = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+            sam = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Sam_Hat1.jpg"))
+
+            # Without a quality range, there's nothing left to do for optimized images.
+            stdout = StringIO()
+            management.call_command("optimize_images", stdout=stdout)
+            self.assertEqual(stdout.getvalue(), "")
+
+            settings.BETTY_JPEG_QUALITY_RANGE = (60, 95)
+            stdout = StringIO()
+            management.call_command("optimize_images", stdout=stdout)
+            self.assertIn("Processed 2 images", stdout.getvalue())
+
+            lenna = Image.objects.get(id=lenna.id)
+            self.assertTrue(lenna.jpeg_quality_searched)
+            self.assertTrue(abs(lenna.jpeg_quality - 95) < 2)
+
+            # Sam_Hat1.jpg is already optimized, so it keeps the default quality...
+            sam = Image.objects.get(id=sam.id)
+            self.assertTrue(sam.jpeg_quality_searched)
+            self.assertEqual(sam.jpeg_quality, None)
+
+            # ...and isn't searched again on the next run.
+            stdout = StringIO()
+            management.call_command("optimize_images", stdout=stdout)
+            self.assertEqual(stdout.getvalue(), "")
+        finally:
+            settings.BETTY_JPEG_QUALITY_RANGE = _cached_range
+
+    def tearDown(self):
+        shutil.rmtree(settings.BETTY_IMAGE_ROOT, ignore_errors=True)